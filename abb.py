@@ -4,9 +4,12 @@ import probe
 from register import Reg, Reg_s32b, Reg_u16, Reg_u32b, Reg_u64b, Reg_text
 from register import Reg_s16
 
-class Reg_serial(Reg, str):
+class Reg_serial(Reg):
     """ ABB meters use a 32-bit integer as serial number. Make it a string
         because that is what dbus (and modbus-tcp) expects. """
+    __slots__ = ()
+    vtype = str
+
     def __init__(self, base, name):
         super().__init__(base, 2, name)
 
@@ -5,7 +5,10 @@ from register import *
 import logging
 log = logging.getLogger(__name__)
 
-class Reg_ver(Reg, str):
+class Reg_ver(Reg):
+    __slots__ = ()
+    vtype = str
+
     def __init__(self, base, name):
         super().__init__(base, 1, name)
 
@@ -90,7 +93,7 @@ class EM24_Meter(device.CustomName, device.EnergyMeter):
 
     def dbus_write_register(self, reg, path, val):
         super().dbus_write_register(reg, path, val)
-        self.sched_reinit()
+        self.sched_reconfigure()
 
 models = {
     1648: {
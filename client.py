@@ -1,9 +1,13 @@
+from collections import deque
+from contextlib import contextmanager
 import os
+import socket
 import struct
 import threading
 import time
 
 from pymodbus.client import *
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 try:
     from pymodbus.utilities import computeCRC
 except ImportError:
@@ -19,12 +23,103 @@ except ImportError:
     from pymodbus.framer.rtu import FramerRTU as ModbusRtuFramer
     from pymodbus.framer.ascii import FramerAscii as ModbusAsciiFramer
 
+import framer
+
+import logging
+log = logging.getLogger(__name__)
+
+class BusLock:
+    '''Reentrant lock granting access in the order it was requested
+
+    Threads waiting for the lock are queued and served first come,
+    first served so that no device sharing a connection is starved.
+    If `gap` is set, the lock is not handed to the next thread until
+    that many seconds after it was last released.
+
+    Urgent requests, such as writes, are queued ahead of all others
+    while keeping their order among themselves.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.urgent_waiting = 0
+        self.owner = None
+        self.depth = 0
+        self.gap = 0
+        self.release_time = 0
+        self.max_waiting = 0
+
+    @property
+    def waiting(self):
+        return len(self.queue)
+
+    def acquire(self, urgent=False):
+        me = threading.get_ident()
+
+        with self.cond:
+            if self.owner == me:
+                self.depth += 1
+                return True
+
+            if urgent:
+                self.queue.insert(self.urgent_waiting, me)
+                self.urgent_waiting += 1
+            else:
+                self.queue.append(me)
+
+            self.max_waiting = max(self.max_waiting, len(self.queue))
+
+            while self.owner is not None or self.queue[0] != me:
+                self.cond.wait()
+
+            self.queue.popleft()
+            if urgent:
+                self.urgent_waiting -= 1
+            self.owner = me
+            self.depth = 1
+            delay = self.release_time + self.gap - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return True
+
+    def release(self):
+        with self.cond:
+            self.depth -= 1
+            if self.depth:
+                return
+
+            self.owner = None
+            self.release_time = time.time()
+            self.cond.notify_all()
+
+    @contextmanager
+    def urgent(self):
+        self.acquire(urgent=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
 
 class RefCount:
+    gateway = False
+    native = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.refcount = 1
         self.in_transaction = False
+        self.lock = BusLock()
+        self.units = set()
+        self.timeouts = 0
 
     def get(self):
         self.refcount += 1
@@ -40,19 +135,228 @@ class RefCount:
         if self.refcount == 0 or self.in_transaction:
             super().close()
 
+    def add_unit(self, unit):
+        self.units.add(unit)
+
+    def del_unit(self, unit):
+        self.units.discard(unit)
+
     def execute(self, *args):
+        with self.lock:
+            try:
+                self.in_transaction = True
+                rr = super().execute(*args)
+            except ModbusIOException:
+                self.timeouts += 1
+                raise
+            finally:
+                self.in_transaction = False
+
+        if isinstance(rr, ModbusIOException):
+            self.timeouts += 1
+
+        return rr
+
+    def execute_pdu(self, unit, pdu, timeout):
+        '''Send a request PDU using the built-in framer
+
+        :param unit: unit id
+        :param pdu: encoded request PDU
+        :param timeout: time to wait for the response
+        :returns: `framer.Response` object
+        '''
+
+        with self.lock:
+            try:
+                self.in_transaction = True
+                return framer.decode_pdu(self.transfer(unit, pdu, timeout))
+            except ModbusIOException:
+                self.timeouts += 1
+                raise
+            finally:
+                self.in_transaction = False
+
+    def transfer(self, unit, pdu, timeout):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.lock.release()
+
+class NetRefCount(RefCount):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.framer = framer.TcpFramer()
+        self.native = native
+
+    def add_unit(self, unit):
+        super().add_unit(unit)
+        if len(self.units) > 1 and not self.gateway:
+            log.info('Multiple units on %s:%d, assuming a gateway', *self.key[1:])
+            self.set_gateway(gateway_gap)
+
+    def set_gateway(self, gap):
+        self.gateway = True
+        self.lock.gap = gap
+
+    def get(self):
+        with net_lock:
+            return super().get()
+
+    def put(self):
+        with net_lock:
+            super().put()
+            if self.refcount == 0 and net_clients.get(self.key) is self:
+                del net_clients[self.key]
+
+class TcpClient(NetRefCount, ModbusTcpClient):
+    method = 'tcp'
+
+    def transfer(self, unit, pdu, timeout):
+        if not self.connected and not self.connect():
+            raise ConnectionException('Failed to connect')
+
+        sock = self.socket
+        old_timeout = sock.gettimeout()
+        tid, frame = self.framer.encode(unit, pdu)
+        deadline = time.time() + timeout
+
+        self.framer.reset()
+
+        try:
+            sock.sendall(frame)
+
+            while True:
+                sock.settimeout(max(deadline - time.time(), 0.001))
+                data = sock.recv(4096)
+
+                if not data:
+                    raise OSError('Connection closed')
+
+                for t, u, rpdu in self.framer.decode(data):
+                    if t == tid and u == unit:
+                        return rpdu
+        except socket.timeout:
+            self.close()
+            raise ModbusIOException('No response from unit %d' % unit)
+        except OSError as ex:
+            self.close()
+            raise ConnectionException(str(ex))
+        finally:
+            if self.socket:
+                self.socket.settimeout(old_timeout)
+
+    def read_pipelined(self, reqs, unit, depth, timeout):
+        '''Send read requests without waiting for each response
+
+        Up to `depth` requests are outstanding at any time, the
+        responses being matched by transaction id.  If the device
+        stops responding, the connection is closed so that any late
+        responses are discarded.
+
+        :param reqs: list of request PDUs
+        :param unit: unit id
+        :param depth: maximum number of outstanding requests
+        :param timeout: time to wait for each response
+        :returns: list of responses, None for requests not answered
+        '''
+
+        with self.lock:
+            try:
+                self.in_transaction = True
+                return self.pipeline(reqs, unit, depth, timeout)
+            finally:
+                self.in_transaction = False
+
+    def pipeline(self, reqs, unit, depth, timeout):
+        if not self.connected and not self.connect():
+            raise ConnectionException('Failed to connect')
+
+        sock = self.socket
+        old_timeout = sock.gettimeout()
+        res = [None] * len(reqs)
+        pending = {}
+        nxt = 0
+
+        self.framer.reset()
+
         try:
-            self.in_transaction = True
-            return super().execute(*args)
+            while nxt < len(reqs) or pending:
+                frames = []
+
+                while nxt < len(reqs) and len(pending) < depth:
+                    tid, frame = self.framer.encode(unit, reqs[nxt])
+                    pending[tid] = nxt
+                    frames.append(frame)
+                    nxt += 1
+
+                if frames:
+                    sock.sendall(b''.join(frames))
+
+                sock.settimeout(timeout)
+                data = sock.recv(4096)
+
+                if not data:
+                    break
+
+                for tid, u, pdu in self.framer.decode(data):
+                    i = pending.pop(tid, None)
+                    if i is None or u != unit:
+                        continue
+                    try:
+                        res[i] = framer.decode_pdu(pdu)
+                    except ModbusIOException as ex:
+                        log.debug('Discarding response: %s', ex)
+        except socket.timeout:
+            pass
+        except OSError as ex:
+            self.close()
+            raise ConnectionException(str(ex))
         finally:
-            self.in_transaction = False
+            if self.socket:
+                self.socket.settimeout(old_timeout)
 
-class TcpClient(RefCount, ModbusTcpClient):
-    method = 'tcp'
+        if pending or nxt < len(reqs):
+            self.timeouts += 1
+            self.close()
 
-class UdpClient(RefCount, ModbusUdpClient):
+        return res
+
+class UdpClient(NetRefCount, ModbusUdpClient):
     method = 'udp'
 
+    def transfer(self, unit, pdu, timeout):
+        if not self.socket and not self.connect():
+            raise ConnectionException('Failed to connect')
+
+        sock = self.socket
+        old_timeout = sock.gettimeout()
+        tid, frame = self.framer.encode(unit, pdu)
+        addr = (self.comm_params.host, self.comm_params.port)
+        deadline = time.time() + timeout
+
+        try:
+            sock.sendto(frame, addr)
+
+            while True:
+                sock.settimeout(max(deadline - time.time(), 0.001))
+                data = sock.recv(4096)
+
+                self.framer.reset()
+                for t, u, rpdu in self.framer.decode(data):
+                    if t == tid and u == unit:
+                        return rpdu
+        except socket.timeout:
+            raise ModbusIOException('No response from unit %d' % unit)
+        except OSError as ex:
+            raise ConnectionException(str(ex))
+        finally:
+            sock.settimeout(old_timeout)
+
     @property
     def timeout(self):
         return self._timeout
@@ -64,6 +368,8 @@ class UdpClient(RefCount, ModbusUdpClient):
             self.socket.settimeout(t)
 
 class SerialClient(RefCount, ModbusSerialClient):
+    rtu_framer = framer.RtuFramer()
+
     def __init__(self, *args, method = None, **kwargs):
         if method == "rtu":
             framer = ModbusRtuFramer
@@ -73,7 +379,8 @@ class SerialClient(RefCount, ModbusSerialClient):
             raise ValueError("RTU or ASCII only")
         self.method = method
         super().__init__(*args, framer=framer, **kwargs)
-        self.lock = threading.RLock()
+        self.native = native and method == 'rtu'
+        self.frame_time = 0
 
     @property
     def timeout(self):
@@ -88,26 +395,82 @@ class SerialClient(RefCount, ModbusSerialClient):
         if self.refcount == 0:
             del serial_ports[os.path.basename(self.params.port)]
 
-    def execute(self, request=None):
-        with self.lock:
-            return super().execute(request)
+    def transfer(self, unit, pdu, timeout):
+        if not self.connected and not self.connect():
+            raise ConnectionException('Failed to open port')
 
-    def __enter__(self):
-        self.lock.acquire()
-        return super().__enter__()
+        port = self.socket
+        old_timeout = port.timeout
+        frame = self.rtu_framer.encode(unit, pdu)
 
-    def __exit__(self, *args):
-        super().__exit__(*args)
-        self.lock.release()
+        # keep the 3.5 character silent interval between frames
+        silence = 3.5 * 11 / self.comm_params.baudrate
+        delay = self.frame_time + silence - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            port.reset_input_buffer()
+            port.write(frame)
+            port.timeout = timeout
+
+            resp = port.read(3)
+            if len(resp) == 3:
+                size = self.rtu_framer.response_size(resp)
+                resp += port.read(size - 3)
+                if len(resp) == size:
+                    try:
+                        return self.rtu_framer.decode(unit, resp)
+                    except ValueError as ex:
+                        raise ModbusIOException(str(ex))
+
+            raise ModbusIOException('No response from unit %d' % unit)
+        finally:
+            self.frame_time = time.time()
+            port.timeout = old_timeout
 
 serial_ports = {}
 
-def make_client(m):
-    if m.method == 'tcp':
-        return TcpClient(m.target, port=m.port)
+native = False
 
-    if m.method == 'udp':
-        return UdpClient(m.target, port=m.port)
+net_clients = {}
+net_lock = threading.RLock()
+
+gateways = set()
+gateway_gap = 0
+
+def add_gateway(target):
+    '''Mark a host as a gateway to serial devices
+
+    :param target: host name or address, optionally with :port
+    '''
+
+    host, _, port = target.partition(':')
+    gateways.add((host, int(port) if port else None))
+
+def make_net_client(m):
+    key = (m.method, m.target, m.port)
+
+    with net_lock:
+        if key in net_clients:
+            return net_clients[key].get()
+
+        if m.method == 'tcp':
+            client = TcpClient(m.target, port=m.port)
+        else:
+            client = UdpClient(m.target, port=m.port)
+
+        client.key = key
+        net_clients[key] = client
+
+        if (m.target, m.port) in gateways or (m.target, None) in gateways:
+            client.set_gateway(gateway_gap)
+
+    return client
+
+def make_client(m):
+    if m.method in ['tcp', 'udp']:
+        return make_net_client(m)
 
     tty = m.target
 
@@ -3,12 +3,15 @@ import device
 import probe
 from register import Reg, Reg_s16, Reg_u16, Reg_u32b, Reg_text, Reg_mapu16
 
-class Reg_Comap_ident(Reg, str):
+class Reg_Comap_ident(Reg):
     """ The Comap controller returns an error if you don't read the entire 16
         registers of the identification. But we don't want to use the entire 16
         registers, we only care about the first 12 characters.  This special
         register allows us to read 16 registers, but only decode the 12
         characters we care about. """
+    __slots__ = ()
+    vtype = str
+
     def __init__(self):
         super().__init__(1307, 16)
 
@@ -118,7 +121,7 @@ class ComAp_Generator(device.Genset):
 
         # Fetch the current state of the coil and populate it
         state = None
-        coils = self.modbus.read_coils(4700, unit=self.unit)
+        coils = self.modbus.read_coils(4700, slave=self.unit)
         if not coils.isError():
             state = int(any(coils.bits))
 
@@ -129,9 +132,9 @@ class ComAp_Generator(device.Genset):
         # This is documented in the Comap global manual, page 204.
         # You need to write the relevant coil to stop/start the genset.
         if value:
-            self.modbus.write_coil(4700, True, unit=self.unit)
+            self.modbus.write_coil(4700, True, slave=self.unit)
         else:
-            self.modbus.write_coil(4700, False, unit=self.unit)
+            self.modbus.write_coil(4700, False, slave=self.unit)
 
         return True
 
@@ -10,7 +10,10 @@ detect via Modbus TCP if a fuel tank sensor is connected to one of the
 analog inputs, therefore tank readings are currently not supported.
 """
 
-class Reg_CRE_ident(Reg, str):
+class Reg_CRE_ident(Reg):
+    __slots__ = ()
+    vtype = str
+
     PLATFORM_TYPE = {
         '0': 'COMPACT',  # COMPACT (56)
         '1': 'ENHANCED'  # ENHANCED (66)
@@ -49,7 +52,10 @@ class Reg_CRE_ident(Reg, str):
         else:
             return self.update(None)
 
-class Reg_CRE_serial(Reg, str):
+class Reg_CRE_serial(Reg):
+    __slots__ = ()
+    vtype = str
+
     def __init__(self):
         super().__init__(4, 3, '/Serial')
 
@@ -1,12 +1,15 @@
 #! /usr/bin/python3 -u
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait
 import dbus
 import dbus.mainloop.glib
 import faulthandler
 from functools import partial
+import math
 import os
 import pymodbus.constants
+import re
 
 from pymodbus.exceptions import ModbusException
 from settingsdevice import SettingsDevice
@@ -20,11 +23,14 @@ sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'
 from settingsdevice import SettingsDevice
 from vedbus import VeDbusService
 
+import client
 import device
 import devspec
 import mdns
+import poller
 import probe
 from scan import *
+import store
 from utils import *
 import watchdog
 
@@ -71,7 +77,9 @@ FAILED_INTERVAL = 10
 MDNS_CHECK_INTERVAL = 5
 MDNS_QUERY_INTERVAL = 60
 SCAN_INTERVAL = 600
-UPDATE_INTERVAL = 100
+IDLE_INTERVAL = 1
+HOUSEKEEPING_INTERVAL = 1
+PROBE_WORKERS = 8
 
 if_blacklist = [
     'ap0',
@@ -95,12 +103,22 @@ class Device:
     def __str__(self):
         return str(self.d)
 
+class ProbeJob:
+    def __init__(self, future, specs, nosave, enable, retry):
+        self.future = future
+        self.specs = specs
+        self.nosave = nosave
+        self.enable = enable
+        self.retry = retry and not nosave
+
 class Client:
-    def __init__(self, name, debug=False):
+    def __init__(self, name, debug=False, workers=0, native=False):
+        client.native = native
         self.name = name
         self.devices = []
         self.failed = []
         self.failed_time = 0
+        self.housekeeping_time = 0
         self.scanner = None
         self.scan_time = time.time()
         self.auto_scan = False
@@ -108,6 +126,12 @@ class Client:
         self.keep_failed = True
         self.svc = None
         self.watchdog = watchdog.Watchdog(9999 if debug else 30)
+        self.poller = poller.Poller(workers, self.wakeup) if workers else None
+        self.prober = ThreadPoolExecutor(max_workers=PROBE_WORKERS,
+                                         thread_name_prefix='probe')
+        self.probe_jobs = []
+        self.probing = {}
+        self.timer = None
 
     def start_scan(self, full=False):
         if self.scanner:
@@ -128,23 +152,23 @@ class Client:
         devices = self.scanner.get_devices()
 
         for d in devices:
-            if d in self.devices:
+            if d in self.devices or d.spec in self.probing:
                 d.destroy()
                 continue
 
-            try:
-                dd = self.init_device(d, False)
-                self.devices.append(dd)
-            except Exception as exc:
-                log.info('Error initialising %s, skipping', d, exc=exc)
+            self.submit_probe([d.spec],
+                              partial(self.read_devices, [(d.spec, d)]),
+                              retry=False)
 
         self.save_devices()
 
     def scan_complete(self):
         self.scan_time = time.time()
 
-        if not self.devices and self.err_exit:
-            os._exit(1)
+        if self.err_exit:
+            self.probe_done(True)
+            if not self.devices:
+                os._exit(1)
 
     def set_scan(self, path, val):
         if val:
@@ -155,11 +179,14 @@ class Client:
         return True
 
     def init_device(self, dev, nosave=False, enable=True):
+        dev.update_notify = self.schedule
         dev.init(self.dbusconn, enable)
         return Device(dev, nosave)
 
     def del_device(self, dev):
         self.devices.remove(dev)
+        if self.poller:
+            self.poller.wait(dev)
         dev.d.destroy()
 
     def dev_failed(self, dev):
@@ -170,41 +197,193 @@ class Client:
         try:
             dev.d.update()
             dev.last_seen = time.time()
-        except ModbusException as ex:
-            if time.time() - dev.last_seen > FAIL_TIMEOUT:
-                dev.d.log.info('Device failed: %s', ex)
-                if self.err_exit:
-                    os._exit(1)
-                self.dev_failed(dev)
-                self.del_device(dev)
-        except Exception:
-            log.exception('Device %s failed', dev)
-            if self.err_exit:
-                os._exit(1)
-            self.dev_failed(dev)
-            self.del_device(dev)
+        except Exception as ex:
+            self.device_error(dev, ex)
+
+    def device_error(self, dev, ex):
+        if isinstance(ex, ModbusException):
+            if time.time() - dev.last_seen <= FAIL_TIMEOUT:
+                return
+            dev.d.log.info('Device failed: %s', ex)
+        else:
+            log.error('Device %s failed', dev, exc_info=ex)
+
+        if self.err_exit:
+            os._exit(1)
+        self.dev_failed(dev)
+        self.del_device(dev)
+
+    def flush_writes(self):
+        for d in self.devices:
+            if not d.d.writes_pending():
+                continue
+
+            if self.poller:
+                self.poller.submit_write(d, d.d.flush_writes)
+            else:
+                d.d.flush_writes()
+
+    def poll_devices(self):
+        for d, ex in self.poller.get_done():
+            if ex:
+                self.device_error(d, ex)
+                continue
+
+            d.d.post_update()
+            d.last_seen = time.time()
+
+        now = time.time()
+
+        for d in list(self.devices):
+            if d in self.poller or d.d.next_due() > now:
+                continue
+
+            try:
+                d.d.check_config()
+            except Exception as ex:
+                self.device_error(d, ex)
+                continue
+
+            if d.d.enabled:
+                self.poller.submit(d, d.d.poll)
+
+    def update_devices(self):
+        self.flush_writes()
+
+        if self.poller:
+            self.poll_devices()
+            return
+
+        # Update one device at a time, returning to the main loop
+        # in between so that writes from D-Bus are not held up by
+        # a full polling cycle.
+        now = time.time()
+        due = [d for d in self.devices if d.d.next_due() <= now]
+
+        if due:
+            self.update_device(min(due, key=lambda d: d.d.next_due()))
 
     def probe_filter(self, dev):
         return dev not in self.devices
 
-    def probe_devices(self, devlist, nosave=False, enable=True):
-        devs = set(devlist) - set(self.devices)
-        devs, failed = probe.probe(devs, filt=self.probe_filter)
+    def probe_group(self, devlist):
+        '''Probe devices and read their information
+
+        This runs in a worker thread, the devices being set up on
+        D-Bus by the main loop afterwards.  The spec of a device found
+        may differ from the one probed, e.g. if the unit was not given.
+
+        :returns: list of (probed spec, device) tuples, list of specs
+                  not found
+        '''
+
+        found = []
+        failed = []
+
+        for m in devlist:
+            devs, fail = probe.probe([m], filt=self.probe_filter)
+            found += [(m, d) for d in devs]
+            failed += fail
 
-        for d in devs:
+        ready, fail = self.read_devices(found)
+
+        return ready, failed + fail
+
+    def read_devices(self, devs):
+        ready = []
+        failed = []
+
+        for m, d in devs:
             try:
-                dd = self.init_device(d, nosave, enable)
-                self.devices.append(dd)
+                d.read_device()
+                ready.append((m, d))
             except Exception:
                 log.exception("Failed: %s", d.spec)
-                failed.append(d.spec)
+                failed.append(m)
                 d.destroy()
 
-        return failed
+        return ready, failed
+
+    def submit_probe(self, specs, func, nosave=False, enable=True,
+                     retry=True):
+        f = self.prober.submit(func)
+        job = ProbeJob(f, specs, nosave, enable, retry)
+
+        for s in specs:
+            self.probing[s] = job
+
+        self.probe_jobs.append(job)
+        f.add_done_callback(lambda f: self.wakeup())
+
+    def probe_devices(self, devlist, nosave=False, enable=True):
+        '''Probe devices in the background
+
+        Devices on different connections, i.e. TCP hosts or serial
+        ports, are probed concurrently.  Those sharing a connection
+        are probed one after another by the same worker.  Devices
+        found are set up by `probe_done()` on the main loop, those
+        not responding being added to the failed list.
+        '''
+
+        groups = {}
+        for d in set(devlist) - set(self.devices) - set(self.probing):
+            groups.setdefault(d.target, []).append(d)
+
+        for g in groups.values():
+            self.submit_probe(g, partial(self.probe_group, g),
+                              nosave, enable)
+
+    def probe_done(self, block=False):
+        '''Set up devices for which probing has finished
+
+        Results for devices removed while being probed are discarded.
+
+        :param block: wait for all pending probes to finish
+        '''
+
+        if block:
+            wait([j.future for j in self.probe_jobs])
+
+        done = []
+        pending = []
+
+        for j in self.probe_jobs:
+            (done if j.future.done() else pending).append(j)
+
+        self.probe_jobs = pending
+
+        for j in done:
+            try:
+                devs, failed = j.future.result()
+            except Exception:
+                log.exception('Probe failed')
+                devs, failed = [], j.specs
+
+            for m, d in devs:
+                if self.probing.get(m) is not j:
+                    d.destroy()
+                    continue
+
+                try:
+                    dd = self.init_device(d, j.nosave, j.enable)
+                    self.devices.append(dd)
+                except Exception:
+                    log.exception("Failed: %s", d.spec)
+                    failed.append(m)
+                    d.destroy()
+
+            for s in failed:
+                if self.probing.get(s) is j and j.retry:
+                    self.failed.append(s)
+
+            for s in j.specs:
+                if self.probing.get(s) is j:
+                    del self.probing[s]
 
     def save_devices(self):
         devs = list(filter(lambda d: not d.nosave, self.devices))
-        devstr = ','.join(sorted(map(str, devs + self.failed)))
+        probing = [s for s, j in self.probing.items() if not j.nosave]
+        devstr = ','.join(sorted(map(str, devs + self.failed + probing)))
         if devstr != self.settings['devices']:
             self.settings['devices'] = devstr
 
@@ -218,7 +397,11 @@ class Client:
             dd = self.devices[self.devices.index(d)]
             self.del_device(dd)
 
-        self.failed = self.probe_devices(new);
+        for d in rem:
+            self.probing.pop(d, None)
+
+        self.failed = []
+        self.probe_devices(new)
         self.save_devices()
 
     def setting_changed(self, name, old, new):
@@ -241,6 +424,7 @@ class Client:
 
     def init_devices(self, force_scan):
         self.update_devlist('', self.settings['devices'])
+        self.probe_done(True)
 
         if not self.keep_failed:
             self.failed = []
@@ -260,6 +444,20 @@ class Client:
         self.init_devices(force_scan)
 
     def update(self):
+        self.probe_done()
+        self.update_devices()
+
+        now = time.time()
+
+        if now - self.housekeeping_time >= HOUSEKEEPING_INTERVAL:
+            self.housekeeping_time = now
+            self.housekeeping()
+
+        self.watchdog.update()
+
+    def housekeeping(self):
+        '''Periodic tasks not tied to polling the devices'''
+
         if self.scanner:
             if self.svc:
                 self.svc['/Scan'] = self.scanner.running
@@ -274,31 +472,72 @@ class Client:
                 if self.svc:
                     self.svc['/ScanProgress'] = None
 
-        for d in self.devices:
-            self.update_device(d)
-
         if self.failed:
             now = time.time()
 
             if now - self.failed_time > FAILED_INTERVAL:
-                self.failed = self.probe_devices(self.failed)
+                failed, self.failed = self.failed, []
+                self.probe_devices(failed)
                 self.failed_time = now
 
             if self.settings['autoscan']:
                 if now - self.scan_time > SCAN_INTERVAL:
                     self.start_scan()
 
-        self.watchdog.update()
+        store.flush()
+
+    def next_update(self):
+        due = min(time.time() + IDLE_INTERVAL,
+                  self.housekeeping_time + HOUSEKEEPING_INTERVAL)
+
+        for d in self.devices:
+            if self.poller and d in self.poller:
+                due = min(due, d.d.write_due)
+            else:
+                due = min(due, d.d.next_due())
+
+        return due
+
+    def schedule(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+
+        delay = math.ceil(1000 * (self.next_update() - time.time()))
+        self.timer = GLib.timeout_add(max(delay, 0), self.update_timer)
 
     def update_timer(self):
+        self.timer = None
+
         try:
             self.update()
         except Exception:
             log.exception('Uncaught exception in update')
 
-        return True
+        self.schedule()
+        return False
+
+    def wakeup(self):
+        '''Run an update as soon as possible
+
+        This may be called from any thread.
+        '''
+
+        GLib.idle_add(self.update_now)
+
+    def update_now(self):
+        if self.timer:
+            GLib.source_remove(self.timer)
+        self.update_timer()
+        return False
 
 class NetClient(Client):
+    def __init__(self, *args, gateways=[], gateway_gap=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gateways = set()
+        client.gateway_gap = gateway_gap
+        for g in gateways:
+            client.add_gateway(g)
+
     def new_scanner(self, full):
         return NetScanner(MODBUS_TCP_PORT, if_blacklist)
 
@@ -321,8 +560,8 @@ class NetClient(Client):
         self.mdns_query_interval = MDNS_QUERY_INTERVAL / 10
         self.mdns_fast_query = time.time()
 
-    def update(self):
-        super().update()
+    def housekeeping(self):
+        super().housekeeping()
 
         now = time.time()
 
@@ -341,6 +580,39 @@ class NetClient(Client):
             if maddr:
                 self.probe_devices(maddr, nosave=True, enable=False)
 
+        self.update_gateways()
+
+    def update_gateways(self):
+        with client.net_lock:
+            clients = [c for c in client.net_clients.values() if c.gateway]
+
+        gws = {}
+        for c in clients:
+            name = re.sub('[^A-Za-z0-9]', '_', '%s_%d' % c.key[1:])
+            gws['/Gateways/' + name] = c
+
+        if not gws and not self.gateways:
+            return
+
+        with self.svc as s:
+            for path in self.gateways - set(gws):
+                s.del_tree(path)
+
+            for path, c in gws.items():
+                if path not in self.gateways:
+                    s.add_path(path + '/Target', '%s:%d' % c.key[1:])
+                    s.add_path(path + '/Units', None)
+                    s.add_path(path + '/QueueDepth', None)
+                    s.add_path(path + '/MaxQueueDepth', None)
+                    s.add_path(path + '/Timeouts', None)
+
+                s[path + '/Units'] = len(c.units)
+                s[path + '/QueueDepth'] = c.lock.waiting
+                s[path + '/MaxQueueDepth'] = c.lock.max_waiting
+                s[path + '/Timeouts'] = c.timeouts
+
+        self.gateways = set(gws)
+
     def init_device(self, dev, *args):
         r = super().init_device(dev, *args)
         r.dev_path = None
@@ -421,17 +693,33 @@ def print_info(_, d):
 def probe_info(devlist):
     probe.probe(map(devspec.fromstring, devlist), print_info)
 
+def shutdown(code):
+    store.flush(True)
+    os._exit(code)
+
 def main():
     parser = ArgumentParser(add_help=True)
     parser.add_argument('-d', '--debug', help='enable debug logging',
                         action='store_true')
     parser.add_argument('-f', '--force-scan', action='store_true')
+    parser.add_argument('-g', '--gateway', action='append', default=[],
+                        help='treat HOST[:PORT] as a gateway to serial '
+                        'devices')
+    parser.add_argument('--gateway-gap', type=int, default=0,
+                        help='minimum time in ms between requests to a '
+                        'gateway')
     parser.add_argument('-m', '--mode', choices=['ascii', 'rtu'], default='rtu')
     parser.add_argument('--models', action='store_true',
                         help='List supported device models')
+    parser.add_argument('-n', '--native', action='store_true',
+                        help='use the built-in framer for register reads '
+                        'and writes')
     parser.add_argument('-P', '--probe', action='append')
     parser.add_argument('-r', '--rate', type=int, action='append')
     parser.add_argument('-s', '--serial')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='poll network devices concurrently using '
+                        'this many threads')
     parser.add_argument('-x', '--exit', action='store_true',
                         help='exit on error')
 
@@ -456,7 +744,6 @@ def main():
 
     log.info('%s v%s', NAME, VERSION)
 
-    signal.signal(signal.SIGINT, lambda s, f: os._exit(1))
     faulthandler.register(signal.SIGUSR1)
     faulthandler.enable()
 
@@ -464,17 +751,24 @@ def main():
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     mainloop = GLib.MainLoop()
 
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, shutdown, 1)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, shutdown, 0)
+
     if args.serial:
         tty = os.path.basename(args.serial)
-        client = SerialClient(tty, args.rate, args.mode, debug=args.debug, **timeout_arg)
+        client = SerialClient(tty, args.rate, args.mode, debug=args.debug,
+                              native=args.native, **timeout_arg)
     else:
-        client = NetClient('tcp', debug=args.debug)
+        client = NetClient('tcp', debug=args.debug, workers=args.workers,
+                           native=args.native,
+                           gateways=args.gateway,
+                           gateway_gap=args.gateway_gap / 1000)
         # XXX timeout?
 
     client.err_exit = args.exit
     client.init(args.force_scan)
 
-    GLib.timeout_add(UPDATE_INTERVAL, client.update_timer)
+    client.schedule()
     mainloop.run()
 
 if __name__ == '__main__':
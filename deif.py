@@ -6,6 +6,8 @@ from register import *
 from utils import getbits
 
 class Reg_DEIF_unit:
+    __slots__ = ()
+
     def __init__(self, *args, conv, **kwargs):
         super().__init__(*args, **kwargs)
         self.conv = conv
@@ -16,12 +18,14 @@ class Reg_DEIF_unit:
         return super().update(val)
 
 class Reg_DEIF_unit_s16(Reg_DEIF_unit, Reg_s16):
-    pass
+    __slots__ = ('conv',)
 
 class Reg_DEIF_unit_u16(Reg_DEIF_unit, Reg_u16):
-    pass
+    __slots__ = ('conv',)
 
 class Reg_DEIF_alarm(Reg):
+    __slots__ = ('level', 'offset')
+
     def __init__(self, base, count, *args, level, offset=0, **kwargs):
         super().__init__(base, count, *args, **kwargs)
         self.level = level
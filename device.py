@@ -1,14 +1,20 @@
 import dbus
 from functools import partial
+import hashlib
+import heapq
 import logging
+import math
 import os
+import threading
 import time
 
 from settingsdevice import SettingsDevice
 from vedbus import VeDbusService, VeDbusItemImport, ServiceContext
 
 import __main__
-from register import Reg
+import framer
+from register import BlockDecoder
+import store
 from utils import *
 
 log = logging.getLogger(__name__)
@@ -17,12 +23,38 @@ class RegList(list):
     def __init__(self, access=None, regs=[]):
         super().__init__(regs)
         self.access = access
+        self.retries = 0
+        self.retry_time = 0
+        self.plans = {}
+        self.pdus = {}
 
-def pack_regs(method, regs):
-    rr = []
-    for r in regs:
-        rr += r if isinstance(r, list) else [r]
-    rr.sort(key=lambda r: r.base)
+        if regs:
+            self.compile()
+
+    def compile(self):
+        self.sort(key=lambda r: r.base)
+        self.start = self[0].base
+        self.size = max(r.base + r.count for r in self) - self.start
+        self.decoder = BlockDecoder(self, self.start, self.size)
+        self.raw = [0] * self.size
+
+    def next_due(self, min_interval):
+        return min(r.time + max(r.max_age, min_interval) for r in self)
+
+    def read_pdu(self, start, count):
+        pdu = self.pdus.get((start, count))
+
+        if pdu is None:
+            pdu = framer.read_pdu(self.access, start, count)
+            self.pdus[(start, count)] = pdu
+
+        return pdu
+
+NET_BYTE_TIME = 8 / 10e6            # assume 10 Mbit/s
+MAX_WRITE_REGS = 123
+
+ILLEGAL_ADDRESS = 2
+MAX_PLANS = 4
 
 def modbus_overhead(method):
     overhead = 5 + 2                # request + response
@@ -36,29 +68,173 @@ def modbus_overhead(method):
 
     return overhead
 
+def modbus_byte_time(method, rate=None):
+    if method == 'rtu':
+        return 11 / rate            # start + 8 data + parity/stop
+    if method == 'ascii':
+        return 2 * 10 / rate        # two 7-bit characters per byte
+    return NET_BYTE_TIME
+
+def reg_changed(reg, addrs):
+    return any(a in addrs for a in range(reg.base, reg.base + reg.count))
+
 def contains_any(a, b, x):
     return any(a <= xx <= b for xx in x) if x else False
 
-def pack_list(rr, access, hole_max, barrier):
-    rr.sort(key=lambda r: r.base)
+def plan_blocks(rr, cost, hole_max=None, barrier=None, min_interval=None):
+    '''Split registers into blocks with the lowest total read cost
+
+    The registers are sorted by address and split into blocks of at
+    most 125 registers.  Reading a block costs `cost[0]` plus `cost[1]`
+    for each register it spans, holes included.  The cheapest split
+    is found by dynamic programming over the sorted registers.
+
+    If `min_interval` is given, the cost of each block is divided by
+    the interval at which it will be read, i.e. the shortest `max_age`
+    of its registers but no less than `min_interval`, giving the cost
+    per unit of time.
+
+    :param rr: list of registers
+    :param cost: tuple of (per request, per register) cost
+    :param hole_max: maximum hole within a block, None for no limit
+    :param barrier: addresses never to be included in a hole
+    :param min_interval: shortest read interval
+    :returns: total cost, list of register lists
+    '''
+
+    rr = sorted(rr, key=lambda r: r.base)
+    n = len(rr)
+
+    def interval(r):
+        if min_interval is None:
+            return 1
+        return max(r.max_age, min_interval)
+
+    split = [False] * n
+    for k in range(n - 1):
+        end = rr[k].base + rr[k].count
+        nxt = rr[k + 1].base
+        split[k] = hole_max is not None and nxt - end > hole_max or \
+            contains_any(end, nxt, barrier)
+
+    best = [0] + [math.inf] * n
+    first = [0] * (n + 1)
+
+    for j in range(1, n + 1):
+        end = 0
+        age = math.inf
+
+        for i in range(j - 1, -1, -1):
+            if i < j - 1 and split[i]:
+                break
+
+            end = max(end, rr[i].base + rr[i].count)
+            nr = end - rr[i].base
+            if nr > 125 and i < j - 1:
+                break
+
+            age = min(age, interval(rr[i]))
+            c = best[i] + (cost[0] + cost[1] * nr) / age
+            if c < best[j]:
+                best[j] = c
+                first[j] = i
+
+    total = best[n]
+    blocks = []
+
+    while n:
+        blocks.insert(0, rr[first[n]:n])
+        n = first[n]
+
+    return total, blocks
+
+def plan_signature(ra, barriers, hole_max, min_interval):
+    '''Return a string identifying the input to `pack_list()`'''
+
+    sig = [(a, [(r.base, r.count, r.max_age, r.name) for r in rr],
+            sorted(barriers[a])) for a, rr in sorted(ra.items())]
+    sig.append((hole_max, min_interval))
+
+    return hashlib.sha1(repr(sig).encode()).hexdigest()
+
+def pack_list(rr, access, cost, hole_max=None, barrier=None,
+              min_interval=None):
+    '''Pack registers into RegList blocks
+
+    See `plan_blocks()` for the meaning of the parameters.  If
+    `min_interval` is given and the registers have different read
+    intervals, the registers are also planned separately for each
+    interval.  This is used instead if the total cost per unit of
+    time is lower, so that slow registers are not read along with
+    fast ones unless this is cheaper.
+
+    :returns: list of RegList objects
+    '''
+
+    total, blocks = plan_blocks(rr, cost, hole_max, barrier, min_interval)
+
+    if min_interval is not None:
+        ages = {}
+        for r in rr:
+            ages.setdefault(max(r.max_age, min_interval), []).append(r)
+
+        if len(ages) > 1:
+            plans = [plan_blocks(r, cost, hole_max, barrier, min_interval)
+                     for r in ages.values()]
+
+            if sum(p[0] for p in plans) < total:
+                blocks = [b for p in plans for b in p[1]]
+
+    return [RegList(access, b) for b in blocks]
+
+class DbusPaths:
+    '''Keep track of the paths added to a D-Bus service
+
+    Paths added between `begin()` and `end()` replace any existing
+    path of the same name, and paths not added again are removed by
+    `end()`.  This allows the paths of a service to be rebuilt in
+    place without taking the service off the bus.
+    '''
+
+    def __init__(self, dbus):
+        self.dbus = dbus
+        self.paths = set()
+        self.old = None
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __getitem__(self, path):
+        return self.dbus[path]
+
+    def __setitem__(self, path, val):
+        self.dbus[path] = val
+
+    def __delitem__(self, path):
+        del self.dbus[path]
+        self.paths.discard(path)
+        if self.old is not None:
+            self.old.discard(path)
 
-    regs = []
-    rg = RegList(access, [rr.pop(0)])
+    def __getattr__(self, name):
+        return getattr(self.dbus, name)
 
-    for r in rr:
-        end = rg[-1].base + rg[-1].count
-        nr = r.base + r.count - rg[0].base
-        if nr > 125 or (r.base - end) > hole_max or \
-           contains_any(end, r.base, barrier):
-            regs.append(rg)
-            rg = RegList()
+    def add_path(self, path, *args, **kwargs):
+        if self.old is not None and path in self.old:
+            del self[path]
 
-        rg.append(r)
+        self.dbus.add_path(path, *args, **kwargs)
+        self.paths.add(path)
 
-    if rg:
-        regs.append(rg)
+    def begin(self):
+        self.old = self.paths
+        self.paths = set()
 
-    return regs
+    def end(self):
+        for path in self.old - self.paths:
+            del self.dbus[path]
+
+        self.old = None
 
 class BaseDevice:
     vendor_id = None
@@ -68,6 +244,11 @@ class BaseDevice:
     refresh_time = None
     age_limit = 4
     age_limit_fast = 1
+    min_interval = 0.1
+    read_retries = 3
+    retry_delay = 0.5
+    pipeline_depth = 1
+    write_single = True
     fast_regs = ('/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power', '/Ac/Power')
     allowed_roles = None
     default_access = 'holding'
@@ -83,7 +264,15 @@ class BaseDevice:
         self.dbus_settings = {}
         self.info_regs = []
         self.data_regs = []
+        self.reg_queue = []
         self.alias_regs = {}
+        self.write_queue = {}
+        self.write_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.write_due = math.inf
+        self.update_notify = None
+        self.unsupported = {}
+        self.need_repack = False
 
     def destroy(self):
         if self.dbus:
@@ -94,24 +283,101 @@ class BaseDevice:
             self.settings._settings = None
             self.settings = None
 
-    def pack_regs(self, regs):
+    def read_cost(self):
+        '''Return the estimated (per request, per register) read time'''
+
+        method = self.modbus.method
+        rate = None
+
+        if method in ['rtu', 'ascii']:
+            rate = self.modbus.comm_params.baudrate
+
+        byte_time = modbus_byte_time(method, rate)
+        overhead = modbus_overhead(method) * byte_time
+
+        # the measured latency includes the transfer of a short frame
+        latency = max(self.latency - overhead - 2 * byte_time, 0)
+
+        return latency + overhead, 2 * byte_time
+
+    def read_hole_max(self):
+        '''Return the largest hole allowed within a block'''
+
         if self.reg_hole_max is not None:
-            hole_max = self.reg_hole_max
-        else:
-            hole_max = (modbus_overhead(self.modbus.method) + 1) // 2
+            return self.reg_hole_max
 
+        return (modbus_overhead(self.modbus.method) + 1) // 2
+
+    def pack_regs(self, regs, min_interval=None, cache=False):
+        cost = self.cost = self.read_cost()
+        hole_max = self.hole_max = self.read_hole_max()
         regs = flatten(regs)
 
+        bad = self.unsupported.get('regs', {})
+        holes = self.unsupported.get('holes', {})
+
         ra = {}
         for r in regs:
-            ra.setdefault(r.access or self.default_access, []).append(r)
+            a = r.access or self.default_access
+            if r.base not in bad.get(a, ()):
+                ra.setdefault(a, []).append(r)
+
+        barriers = {a: list(self.reg_barrier or []) +
+                    holes.get(a, []) + bad.get(a, []) for a in ra}
+
+        if cache:
+            sig = plan_signature(ra, barriers, hole_max, min_interval)
+            rr = self.load_plan(ra, sig)
+        else:
+            rr = None
+
+        if rr is None:
+            rr = []
+            for a, r in ra.items():
+                rr += pack_list(r, a, cost, hole_max, barriers[a],
+                                min_interval)
+            if cache:
+                self.save_plan(ra, sig, rr)
 
-        rr = []
-        for a, r in ra.items():
-            rr += pack_list(r, a, hole_max, self.reg_barrier)
+        self.log.debug('Packed %d registers into %d blocks',
+                       len(regs), len(rr))
 
         return rr
 
+    def load_plan(self, ra, sig):
+        '''Return the saved packing of the registers, if any'''
+
+        plan = store.get('devices', self.state_key()).get('plans', {})
+        plan = plan.get(sig)
+
+        if not plan:
+            return None
+
+        try:
+            rr = [RegList(a, [ra[a][i] for i in idx]) for a, idx in plan]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+
+        used = set(id(r) for b in rr for r in b)
+        if len(used) != sum(map(len, ra.values())) or \
+           len(used) != sum(map(len, rr)):
+            return None
+
+        return rr
+
+    def save_plan(self, ra, sig, rr):
+        index = {id(r): i for a in ra for i, r in enumerate(ra[a])}
+        key = self.state_key()
+
+        plans = store.get('devices', key).get('plans', {})
+        plans.pop(sig, None)
+        plans[sig] = [[b.access, [index[id(r)] for r in b]] for b in rr]
+
+        while len(plans) > MAX_PLANS:
+            del plans[next(iter(plans))]
+
+        store.update('devices', key, plans=plans)
+
     def read_modbus(self, start, count, access=None):
         if access is None:
             access = self.default_access
@@ -132,54 +398,399 @@ class BaseDevice:
         reg.decode(rr.registers)
         return reg.value
 
-    def write_modbus(self, base, val):
-        if len(val) == 1:
-            self.modbus.write_register(base, val[0], unit=self.unit)
-        else:
-            self.modbus.write_registers(base, val, unit=self.unit)
+    def read_block(self, regs, start, count):
+        if self.modbus.native:
+            return self.modbus.execute_pdu(self.unit,
+                                           regs.read_pdu(start, count),
+                                           self.timeout)
+
+        return self.read_modbus(start, count, regs.access)
+
+    def write_modbus(self, base, val, since=None):
+        '''Write registers ahead of any pending reads
+
+        :param base: first register address
+        :param val: list of register values
+        :param since: time the write was requested, defaults to now
+        '''
+
+        if since is None:
+            since = time.time()
+
+        with self.modbus.lock.urgent():
+            if len(val) == 1 and self.write_single:
+                rr = self.modbus.write_register(base, val[0], slave=self.unit)
+            elif self.modbus.native:
+                rr = self.modbus.execute_pdu(self.unit,
+                                             framer.write_pdu(base, val),
+                                             self.timeout)
+            else:
+                rr = self.modbus.write_registers(base, val, slave=self.unit)
+
+        if not rr.isError():
+            self.log.debug('Write to %#04x acknowledged after %.1f ms',
+                           base, 1000 * (time.time() - since))
+
+        return rr
 
     def write_register(self, reg, val):
         reg.value = val
+        reg.time = 0
         self.write_modbus(reg.base, reg.encode())
 
+    def queue_write(self, reg, val):
+        '''Write a register as soon as the bus is available
+
+        Repeated writes to a register before then only write the
+        last value.
+        '''
+
+        now = time.time()
+
+        with self.write_lock:
+            self.write_queue[reg.base] = (reg, val, now)
+            self.write_due = min(self.write_due, now)
+
+        self.request_update()
+
+    def writes_pending(self):
+        return bool(self.write_queue)
+
+    def request_update(self):
+        '''Tell the client that next_due() may have changed'''
+
+        if self.update_notify:
+            self.update_notify()
+
+    def write_groups(self):
+        '''Take the queued writes and merge adjacent registers
+
+        :returns: list of lists of (register, request time) tuples
+        '''
+
+        with self.write_lock:
+            queue = self.write_queue
+            self.write_queue = {}
+            self.write_due = math.inf
+
+        groups = []
+
+        for base in sorted(queue):
+            reg, val, t = queue[base]
+            reg.value = val
+            reg.time = 0
+
+            if groups:
+                g = groups[-1]
+                end = g[-1][0].base + g[-1][0].count
+                size = end - g[0][0].base + reg.count
+                if base == end and size <= MAX_WRITE_REGS:
+                    g.append((reg, t))
+                    continue
+
+            groups.append([(reg, t)])
+
+        return groups
+
+    def flush_writes(self):
+        '''Write queued registers, merging adjacent ones'''
+
+        with self.flush_lock:
+            self.send_writes(self.write_groups())
+
+    def send_writes(self, groups):
+        for g in groups:
+            regs = [r for r, t in g]
+            base = regs[0].base
+
+            if len(regs) > 1:
+                try:
+                    rr = self.write_modbus(base,
+                                           [v for r in regs for v in r.encode()],
+                                           min(t for r, t in g))
+                    if not rr.isError():
+                        continue
+                    self.log.debug('Merged write to %#04x failed: %s',
+                                   base, rr)
+                except Exception as ex:
+                    self.log.debug('Merged write to %#04x failed: %s',
+                                   base, ex)
+
+            for reg, t in g:
+                try:
+                    self.write_modbus(reg.base, reg.encode(), t)
+                except Exception:
+                    log.exception('Write regs')
+
+    def read_registers(self, regs):
+        '''Read registers in as few requests as possible
+
+        The registers of a block which cannot be read as a whole
+        are read one by one instead, raising an exception on error.
+        '''
+
+        for rl in self.pack_regs(regs):
+            rr = self.read_block(rl, rl.start, rl.size)
+
+            if rr.isError():
+                self.log.debug('Error reading registers %#04x-%#04x: %s',
+                               rl.start, rl.start + rl.size - 1, rr)
+                for reg in rl:
+                    self.read_register(reg)
+                continue
+
+            for reg in rl:
+                base = reg.base - rl.start
+                reg.decode(rr.registers[base:base + reg.count])
+
     def read_info_regs(self, d):
+        self.read_registers(self.info_regs)
+
         for reg in self.info_regs:
-            self.read_register(reg)
             d[reg.name] = reg
 
+    def plan_read(self, regs, stale):
+        if all(stale):
+            return [regs]
+
+        key = tuple(stale)
+        plan = regs.plans.get(key)
+
+        if plan is None:
+            rr = [r for r, s in zip(regs, stale) if s]
+            total, plan = plan_blocks(rr, self.cost, self.hole_max,
+                                      self.reg_barrier)
+
+            if total >= self.cost[0] + self.cost[1] * regs.size:
+                plan = [regs]
+
+            if len(regs.plans) >= 16:
+                regs.plans.clear()
+            regs.plans[key] = plan
+
+        return plan
+
+    def data_reads(self, regs, now):
+        stale = [now - r.time >= r.max_age for r in regs]
+
+        if not any(stale):
+            return []
+
+        reads = []
+
+        for rg in self.plan_read(regs, stale):
+            start = rg[0].base
+            count = max(r.base + r.count for r in rg) - start
+            reads.append((start, count))
+
+        return reads
+
+    def store_data(self, regs, start, count, rr, now, changed):
+        if getattr(rr, 'exception_code', None) == ILLEGAL_ADDRESS:
+            self.learn_unsupported(regs, start, count)
+            return False
+
+        if rr is None or rr.isError():
+            if regs.retries < self.read_retries:
+                regs.retries += 1
+                regs.retry_time = now + self.retry_delay
+                self.log.debug('Error reading registers %#04x-%#04x, '
+                               'retry %d: %s', start, start + count - 1,
+                               regs.retries, rr)
+                return False
+
+            regs.retries = 0
+            raise Exception('Error reading registers %#04x-%#04x: %s' %
+                            (start, start + count - 1, rr))
+
+        base = start - regs.start
+        new = rr.registers
+
+        if new != regs.raw[base:base + count]:
+            for i in range(count):
+                if new[i] != regs.raw[base + i]:
+                    changed.add(start + i)
+            regs.raw[base:base + count] = new
+
+        return True
+
+    def learn_unsupported(self, regs, start, count):
+        '''Find the registers causing an illegal address error
+
+        The registers in the failing block are bisected until the
+        offending ones are found.  These are dropped and the data
+        registers packed again at the end of the update.  If all
+        parts of the block can be read on their own, the hole
+        between them is what the device rejects and it is kept out
+        of future blocks instead.
+        '''
+
+        rr = [r for r in regs if start <= r.base < start + count]
+        bad, holes = self.bisect_block(regs, rr)
+
+        self.log.info('Unsupported registers %s, holes at %s',
+                      ', '.join('%#04x' % r.base for r in bad) or 'none',
+                      ', '.join('%#04x' % h for h in holes) or 'none')
+
+        for key, new in ('regs', [r.base for r in bad]), ('holes', holes):
+            learned = self.unsupported.setdefault(key, {})
+            addrs = learned.setdefault(regs.access, [])
+            addrs += [a for a in new if a not in addrs]
+
+        store.update('models', self.learn_key(), unsupported=self.unsupported)
+        store.flush()
+        self.need_repack = True
+
+    def bisect_block(self, regs, rr):
+        if len(rr) == 1:
+            return rr, []
+
+        half = len(rr) // 2
+        bad = []
+        holes = []
+
+        for part in rr[:half], rr[half:]:
+            start = part[0].base
+            count = max(r.base + r.count for r in part) - start
+            res = self.read_block(regs, start, count)
+
+            if not res.isError():
+                continue
+
+            if res.exception_code != ILLEGAL_ADDRESS:
+                raise Exception('Error reading registers %#04x-%#04x: %s' %
+                                (start, start + count - 1, res))
+
+            b, h = self.bisect_block(regs, part)
+            bad += b
+            holes += h
+
+        if not bad and not holes:
+            holes.append(max(r.base + r.count for r in rr[:half]))
+
+        return bad, holes
+
+    def learn_key(self):
+        '''Return the key under which learned registers are saved'''
+
+        fw = self.info.get('/FirmwareVersion')
+        return '%s:%s:%s' % (self.vendor_id, self.model, fw)
+
+    def state_key(self):
+        '''Return the key under which learned device state is saved'''
+
+        fw = self.info.get('/FirmwareVersion')
+        return '%s:%s' % (self.get_ident(), fw)
+
+    def repack_data_regs(self):
+        regs = flatten(self.data_regs)
+        self.data_regs = self.pack_regs(regs, self.min_interval, True)
+
+        # the new blocks start with empty raw data
+        for r in regs:
+            r.time = 0
+
+        self.reg_queue = [(0, n, r) for n, r in enumerate(self.data_regs)]
+        self.need_repack = False
+
     def read_data_regs(self, regs, d):
         now = time.time()
+        latency = 0
+        changed = set()
 
-        if all(now - r.time < r.max_age for r in regs):
+        reads = self.data_reads(regs, now)
+        if not reads:
             return
 
-        start = regs[0].base
-        count = regs[-1].base + regs[-1].count - start
+        for start, count in reads:
+            t0 = time.time()
+            rr = self.read_block(regs, start, count)
+            latency = max(latency, time.time() - t0)
 
-        for _ in range(4):
-            rr = self.read_modbus(start, count, regs.access)
-            if not rr.isError():
-                break
-            time.sleep(.5)
+            if not self.store_data(regs, start, count, rr, now, changed):
+                return
 
-        latency = time.time() - now
+        self.decode_data_regs(regs, changed, now, d)
 
-        if rr.isError():
-            raise Exception('Error reading registers %#04x-%#04x: %s' %
-                            (start, start + count - 1, rr))
+        return latency
+
+    def decode_data_regs(self, regs, changed, now, d):
+        regs.retries = 0
+        values = None
+
+        for i, reg in enumerate(regs.decoder.regs):
+            if now - reg.time < reg.max_age:
+                continue
+
+            if reg.time and not reg_changed(reg, changed):
+                reg.time = now
+                continue
 
-        for reg in regs:
-            base = reg.base - start
-            end = base + reg.count
+            if values is None:
+                values = regs.decoder.decode(regs.raw)
 
-            if now - reg.time > reg.max_age:
-                if reg.decode(rr.registers[base:end]) or not reg.time:
-                    if reg.name:
-                        d[reg.name] = reg.copy_if_valid()
+            setter = regs.decoder.setters[i]
+            self.reg_updated(reg, setter(values[i]), now, d)
+
+        for reg in regs.decoder.other:
+            if now - reg.time < reg.max_age:
+                continue
+
+            if reg.time and not reg_changed(reg, changed):
                 reg.time = now
+                continue
+
+            base = reg.base - regs.start
+            val = regs.raw[base:base + reg.count]
+            self.reg_updated(reg, reg.decode(val), now, d)
+
+    def read_pipelined(self, due, d):
+        now = time.time()
+        jobs = [(r, self.data_reads(r, now)) for r in due]
+        reqs = [r.read_pdu(start, count)
+                for r, reads in jobs for start, count in reads]
+
+        if not reqs:
+            return
+
+        t0 = time.time()
+        res = self.modbus.read_pipelined(reqs, self.unit,
+                                         self.pipeline_depth, self.timeout)
+        latency = time.time() - t0
+
+        if any(rr is None for rr in res):
+            self.pipeline_timeout()
+
+        res = iter(res)
+
+        for regs, reads in jobs:
+            changed = set()
+            ok = bool(reads)
+
+            for start, count in reads:
+                rr = next(res)
+
+                if ok:
+                    ok = self.store_data(regs, start, count, rr, now,
+                                         changed)
+
+            if ok:
+                self.decode_data_regs(regs, changed, now, d)
 
         return latency
 
+    def pipeline_timeout(self):
+        if self.pipeline_depth > 1:
+            self.pipeline_depth //= 2
+            self.log.info('Request timed out, pipeline depth reduced to %d',
+                          self.pipeline_depth)
+
+    def reg_updated(self, reg, changed, now, d):
+        if changed or not reg.time:
+            if reg.name:
+                d[reg.name] = reg.dbus_value()
+        reg.time = now
+
     def read_info(self):
         if not self.info:
             self.read_info_regs(self.info)
@@ -225,6 +836,9 @@ class BaseDevice:
         return False
 
     def add_settings(self, settings):
+        settings = {k: v for k, v in settings.items()
+                    if k not in self._settings}
+
         for s in settings.values():
             if not s[0].startswith('/Settings/'):
                 s[0] = self.settings_path + s[0]
@@ -270,7 +884,8 @@ class BaseDevice:
 
     def dbus_write_register(self, reg, path, val):
         try:
-            val = get_super(Reg, reg)(val)
+            if reg.vtype:
+                val = reg.vtype(val)
 
             if callable(reg.write):
                 return reg.write(val)
@@ -283,25 +898,30 @@ class BaseDevice:
                 if not reg.write[0] <= val <= reg.write[1]:
                     return False
 
-            self.write_register(reg, val)
+            self.queue_write(reg, val)
             return True
         except Exception:
             log.exception("Write regs")
 
         return False
 
+    def dbus_text(self, reg, path, val):
+        return str(reg)
+
     def dbus_add_register(self, r, name=None):
         if name is None:
             name = r.name
 
         if name in self.dbus:
             del self.dbus[name]
-        v = r.copy_if_valid()
+        v = r.dbus_value()
+        tcb = partial(self.dbus_text, r)
         if r.write:
             cb = partial(self.dbus_write_register, r)
-            self.dbus.add_path(name, v, writeable=True, onchangecallback=cb)
+            self.dbus.add_path(name, v, writeable=True, onchangecallback=cb,
+                               gettextcallback=tcb)
         else:
-            self.dbus.add_path(name, v)
+            self.dbus.add_path(name, v, gettextcallback=tcb)
 
         for alias in self.alias_regs.get(name, ()):
             self.dbus_add_reg_alias(r, alias)
@@ -313,7 +933,7 @@ class BaseDevice:
     def dbus_update_alias(self, name, onchange, reg):
         if onchange:
             onchange(reg)
-        self.dbus[name] = reg.copy_if_valid()
+        self.dbus[name] = reg.dbus_value()
 
     def set_max_age(self, reg):
         if reg.name in self.fast_regs:
@@ -326,8 +946,11 @@ class BaseDevice:
 
         svcname = 'com.victronenergy.%s.%s' % (self.role, ident)
         self._dbus = VeDbusService(svcname, private_bus(), register=False)
-        self.dbus = ServiceContext(self._dbus)
+        self.dbus = DbusPaths(ServiceContext(self._dbus))
+
+        self.init_dbus_paths()
 
+    def init_dbus_paths(self):
         self.dbus.add_path('/Mgmt/ProcessName', __main__.NAME)
         self.dbus.add_path('/Mgmt/ProcessVersion', __main__.VERSION)
         self.dbus.add_path('/Mgmt/Connection', self.connection())
@@ -351,25 +974,58 @@ class BaseDevice:
             self.dbus_add_register(self.info[p])
 
     def init_data_regs(self):
-        self.data_regs = self.pack_regs(self.data_regs)
+        regs = flatten(self.data_regs)
+        self.unsupported = \
+            store.get('models', self.learn_key()).get('unsupported', {})
 
-        for r in self.data_regs:
-            for rr in r:
-                if rr.max_age is None:
-                    self.set_max_age(rr)
-                if rr.name:
-                    self.dbus_add_register(rr)
+        for r in regs:
+            if r.max_age is None:
+                self.set_max_age(r)
+
+        self.data_regs = self.pack_regs(regs, self.min_interval, True)
+
+        for r in regs:
+            if r.name:
+                self.dbus_add_register(r)
+
+        self.reg_queue = [(0, n, r) for n, r in enumerate(self.data_regs)]
 
     def update_data_regs(self):
+        if self.write_queue:
+            self.flush_writes()
+
         latency = []
+        now = time.time()
+        due = []
 
-        for r in self.data_regs:
-            t = self.read_data_regs(r, self.dbus)
-            if t:
-                latency.append(t)
+        while self.reg_queue and self.reg_queue[0][0] <= now:
+            due.append(heapq.heappop(self.reg_queue))
+
+        try:
+            if self.pipeline_depth > 1 and not self.modbus.gateway:
+                t = self.read_pipelined([r for _, n, r in due], self.dbus)
+                if t:
+                    latency.append(t)
+            else:
+                for _, n, r in due:
+                    t = self.read_data_regs(r, self.dbus)
+                    if t:
+                        latency.append(t)
+        finally:
+            for _, n, r in due:
+                t = max(r.next_due(self.min_interval),
+                        now + self.min_interval, r.retry_time)
+                heapq.heappush(self.reg_queue, (t, n, r))
+
+        if self.need_repack:
+            self.repack_data_regs()
 
         return latency
 
+    def next_due(self):
+        due = self.reg_queue[0][0] if self.reg_queue else math.inf
+        return min(due, self.write_due)
+
     def post_update(self):
         self.dbus.flush()
 
@@ -389,15 +1045,23 @@ class BaseDevice:
         return str(self.info.get('/CustomName', '')) or self.productname
 
 class ModbusDevice(BaseDevice):
+    pipeline_max = 1
+
     def __init__(self, spec, modbus, model):
         super().__init__()
         self.spec = spec
         self.modbus = modbus.get()
+        self.modbus_ref = True
         self.unit = spec.unit
         self.model = model
         self.subdevices = []
         self.latency = modbus.comm_params.timeout_connect
+        self.saved_latency = None
+        self.probe_access = None
+        self.probe_model = None
+        self.info_read = False
         self.need_reinit = False
+        self.need_reconfigure = False
         self.log = logging.getLogger(str(self))
         self.log.addFilter(self)
 
@@ -411,7 +1075,26 @@ class ModbusDevice(BaseDevice):
 
         super().destroy()
         self.info.clear()
-        self.modbus.put()
+        self.modbus.del_unit(self.unit)
+        self.modbus_put()
+
+    def modbus_get(self):
+        '''Take a reference to the Modbus client unless holding one'''
+
+        if not self.modbus_ref:
+            self.modbus.get()
+            self.modbus_ref = True
+
+    def modbus_put(self):
+        '''Release the reference to the Modbus client if holding one
+
+        The client may be shared with other units on the same host so
+        it must be released exactly once.
+        '''
+
+        if self.modbus_ref:
+            self.modbus_ref = False
+            self.modbus.put()
 
     def __eq__(self, other):
         return str(self) == str(other)
@@ -448,8 +1131,22 @@ class ModbusDevice(BaseDevice):
 
         self.settings.addSettings({
             'enabled':  [self.settings_path + '/Enabled', def_enable, 0, 1],
+            'readretries': [self.settings_path + '/ReadRetries',
+                            self.read_retries, 0, 10],
+            'retrydelay': [self.settings_path + '/ReadRetryDelay',
+                           self.retry_delay, 0, 10],
         })
 
+        self.read_retries = self.settings['readretries']
+        self.retry_delay = self.settings['retrydelay']
+
+        if self.modbus.method == 'tcp':
+            self.settings.addSettings({
+                'pipelinedepth': [self.settings_path + '/PipelineDepth',
+                                  self.pipeline_max, 1, 16],
+            })
+            self.pipeline_max = self.settings['pipelinedepth']
+
         if self.enabled:
             self.settings['enabled'] = 1
         else:
@@ -464,35 +1161,131 @@ class ModbusDevice(BaseDevice):
                 self.set_enabled(bool(new))
             return True
 
+        if name == 'readretries':
+            self.read_retries = new
+            return True
+
+        if name == 'retrydelay':
+            self.retry_delay = new
+            return True
+
+        if name == 'pipelinedepth':
+            self.pipeline_max = self.pipeline_depth = new
+            return True
+
         return False
 
     def reinit(self):
+        self.flush_writes()
+        # keep the client open while the device is set up again
         self.modbus.get()
         self.destroy()
+        self.modbus_ref = True
         self.init(self.settings_dbus, self.enabled)
         self.need_reinit = False
 
     def sched_reinit(self):
         self.need_reinit = True
 
-    def init(self, dbus, enable=True):
-        self.enabled = enable
+    def reconfigure(self):
+        '''Update the registers and D-Bus paths in place
+
+        Unlike `reinit()` this keeps the D-Bus service and settings,
+        only adding and removing paths as needed.  Registers still
+        present keep their last value until read again.
+        '''
+
+        self.flush_writes()
+
+        role = self.role
+        subdevices = self.subdevices
+        old = {(type(r), r.base, r.count, r.name): r
+               for r in flatten(self.data_regs)}
+
         self.modbus.timeout = self.timeout
+        self.device_reconfigure()
+
+        if self.role != role:
+            self.reinit()
+            return
+
+        for r in flatten(self.data_regs):
+            o = old.get((type(r), r.base, r.count, r.name))
+            if o and r.value is None:
+                r.value = o.value
+
+        self.dbus.begin()
+        self.init_dbus_paths()
+        self.init_data_regs()
+        self.device_init_late()
+        self.dbus.end()
+        self.dbus.flush()
+        self.need_reconfigure = False
+
+        if self.subdevices is not subdevices:
+            for s in subdevices:
+                s.destroy()
+            for s in self.subdevices:
+                s.init()
+
+    def sched_reconfigure(self):
+        self.need_reconfigure = True
+
+    def device_reconfigure(self):
+        '''Rebuild the register lists after a configuration change
+
+        The default is to run `device_init()` again.
+        '''
+
+        self.info.clear()
         self.device_init()
         self.read_info()
+
+    def check_config(self):
+        '''Apply a pending reinit or reconfiguration'''
+
+        if self.need_reinit:
+            self.reinit()
+        elif self.need_reconfigure:
+            self.reconfigure()
+
+    def read_device(self):
+        '''Read the device information ahead of `init()`
+
+        Only the Modbus connection is used so this may be called
+        from a worker thread.
+        '''
+
+        self.modbus.timeout = self.timeout
+        self.device_init()
+        self.read_info()
+        self.load_state()
+        self.info_read = True
+
+    def init(self, dbus, enable=True):
+        self.enabled = enable
+
+        if not self.info_read:
+            self.read_device()
+        self.info_read = False
+
         self.init_device_settings(dbus)
+        self.pipeline_depth = self.pipeline_max
         self.need_reinit = False
+        self.need_reconfigure = False
 
         if not self.enabled:
-            self.modbus.put()
+            self.modbus_put()
             return
 
+        self.modbus.add_unit(self.unit)
         self.init_dbus()
         self.init_data_regs()
 
         self.latfilt = LatencyFilter(self.latency)
         self.device_init_late()
         self.need_reinit = False
+        self.need_reconfigure = False
 
         self.dbus.flush()
         self._dbus.register()
@@ -501,26 +1294,73 @@ class ModbusDevice(BaseDevice):
             s.init()
 
     def update(self):
-        if self.need_reinit:
-            self.reinit()
+        self.check_config()
 
         if not self.enabled:
             return
 
+        self.poll()
+        self.post_update()
+
+    def post_update(self):
+        super().post_update()
+
+        for s in self.subdevices:
+            s.post_update()
+
+    def poll(self):
         self.modbus.timeout = self.timeout
         self.device_update()
-        self.post_update()
+
+    def next_due(self):
+        if self.need_reinit or self.need_reconfigure:
+            return 0
+
+        if not self.enabled:
+            return math.inf
+
+        return min([super().next_due()] +
+                   [s.next_due() for s in self.subdevices])
+
+    def writes_pending(self):
+        return super().writes_pending() or \
+            any(s.writes_pending() for s in self.subdevices)
+
+    def flush_writes(self):
+        super().flush_writes()
+
+        for s in self.subdevices:
+            s.flush_writes()
 
     def device_update(self):
         latency = self.update_data_regs()
 
         for s in self.subdevices:
             s.device_update()
-            s.post_update()
 
         if latency:
             self.latency = self.latfilt.filter(latency)
             self.timeout = max(self.min_timeout, self.latency * 4)
+            self.save_state()
+
+    def load_state(self):
+        '''Use the latency learned before the last restart'''
+
+        state = store.get('devices', self.state_key())
+        self.saved_latency = state.get('latency')
+
+        if self.saved_latency:
+            self.latency = self.saved_latency
+            self.timeout = max(self.min_timeout, self.latency * 4)
+            self.modbus.timeout = self.timeout
+
+    def save_state(self):
+        if self.saved_latency and \
+           abs(self.latency - self.saved_latency) < 0.25 * self.saved_latency:
+            return
+
+        self.saved_latency = self.latency
+        store.update('devices', self.state_key(), latency=self.latency)
 
     def set_enabled(self, enabled):
         if enabled == self.enabled:
@@ -529,7 +1369,7 @@ class ModbusDevice(BaseDevice):
         self.enabled = enabled
         self.settings['enabled'] = enabled
         if enabled:
-            self.modbus.get()
+            self.modbus_get()
         self.sched_reinit()
 
 class SubDevice(BaseDevice):
@@ -551,12 +1391,34 @@ class SubDevice(BaseDevice):
         self.productname = parent.productname
         self.log = parent.log
 
+    @property
+    def latency(self):
+        return self.parent.latency
+
+    @property
+    def read_retries(self):
+        return self.parent.read_retries
+
+    @property
+    def retry_delay(self):
+        return self.parent.retry_delay
+
+    @property
+    def timeout(self):
+        return self.parent.timeout
+
+    def request_update(self):
+        self.parent.request_update()
+
     def connection(self):
         return self.parent.connection()
 
     def get_ident(self):
         return self.parent.get_ident() + '_%s' % self.subid
 
+    def learn_key(self):
+        return self.parent.learn_key() + ':%s' % self.subid
+
     def init(self):
         self.device_init()
         self.read_info()
@@ -575,6 +1437,9 @@ class SubDevice(BaseDevice):
     def sched_reinit(self):
         self.parent.sched_reinit()
 
+    def sched_reconfigure(self):
+        self.parent.sched_reconfigure()
+
     def device_update(self):
         self.update_data_regs()
 
@@ -7,9 +7,12 @@ from register import Reg, Reg_s16, Reg_u16, Reg_s32b, Reg_u32b, Reg_mapu16
 import logging
 log = logging.getLogger(__name__)
 
-class Reg_DSE_serial(Reg, str):
+class Reg_DSE_serial(Reg):
     """ Deep Sea Electronics Controllers use a 32-bit integer as serial number. Make it a string
         because that is what dbus (and modbus-tcp) expects. """
+    __slots__ = ()
+    vtype = str
+
     def __init__(self, base, name):
         super().__init__(base, 2, name)
 
@@ -17,7 +20,7 @@ class Reg_DSE_serial(Reg, str):
         v = struct.unpack('>I', struct.pack('>2H', *values))
         return self.update(str(v[0]))
 
-class Reg_DSE_ident(Reg, str):
+class Reg_DSE_ident(Reg):
     """ The Deep Sea Electronics controller identifies itself by a combination
         of manufacturer code and model number. The GenComm manual states:
 
@@ -26,6 +29,9 @@ class Reg_DSE_ident(Reg, str):
 
         Therefore we concatenate manufacturer code and model number to a
         dash-separated string. """
+    __slots__ = ()
+    vtype = str
+
     def __init__(self):
         super().__init__(768, 2)
 
@@ -47,21 +53,27 @@ INVALID = [
 ]
 
 class Reg_DSE_num:
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if not self.invalid:
             self.invalid = [x & self.invalid_mask for x in INVALID]
 
 class Reg_DSE_s16(Reg_DSE_num, Reg_s16):
+    __slots__ = ()
     invalid_mask = 0x7fff
 
 class Reg_DSE_u16(Reg_DSE_num, Reg_u16):
+    __slots__ = ()
     invalid_mask = 0xffff
 
 class Reg_DSE_s32b(Reg_DSE_num, Reg_s32b):
+    __slots__ = ()
     invalid_mask = 0x7fffffff
 
 class Reg_DSE_u32b(Reg_DSE_num, Reg_u32b):
+    __slots__ = ()
     invalid_mask = 0xffffffff
 
 class DSE_Tank(device.CustomName, device.Tank, device.SubDevice):
@@ -130,7 +142,7 @@ class DSE_Generator(device.CustomName, device.ErrorId, device.Genset):
         if self.scf_reg_vals is not None: return
 
         reg_base = 4096
-        rr = self.modbus.read_holding_registers(reg_base, 8, unit=self.unit)
+        rr = self.modbus.read_holding_registers(reg_base, 8, slave=self.unit)
         if rr.isError():
             self.log.error('Error reading GenComm system control function registers 4096 to 4103: %s', rr)
             raise Exception(rr)
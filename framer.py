@@ -0,0 +1,153 @@
+import struct
+
+from pymodbus.exceptions import ModbusIOException
+
+import logging
+log = logging.getLogger(__name__)
+
+READ_FUNCS = {
+    'holding': 3,
+    'input': 4,
+}
+
+MBAP = struct.Struct('>HHHB')
+
+def make_crc_table():
+    table = []
+
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+
+    return table
+
+CRC_TABLE = make_crc_table()
+
+def crc16(data):
+    crc = 0xffff
+    for b in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ b) & 0xff]
+    return crc
+
+class Response:
+    '''Result of a request sent outside of pymodbus
+
+    Mimics the parts of the pymodbus response classes used by the
+    device code.
+    '''
+
+    def __init__(self, fc, registers=None, exception_code=None):
+        self.function_code = fc
+        self.registers = registers
+        self.exception_code = exception_code
+
+    def isError(self):
+        return self.exception_code is not None
+
+    def __str__(self):
+        if self.isError():
+            return 'Exception Response(%d, %d, %s)' % (
+                self.function_code | 0x80, self.function_code,
+                self.exception_code)
+        return 'Response(%d, %s)' % (self.function_code, self.registers)
+
+def read_pdu(access, start, count):
+    return struct.pack('>BHH', READ_FUNCS[access], start, count)
+
+def write_pdu(start, values):
+    n = len(values)
+    return struct.pack('>BHHB%dH' % n, 16, start, n, 2 * n, *values)
+
+def decode_pdu(pdu):
+    if not pdu:
+        raise ModbusIOException('Empty response')
+
+    fc = pdu[0]
+
+    if fc & 0x80:
+        if len(pdu) != 2:
+            raise ModbusIOException('Invalid exception response %s' % pdu)
+        return Response(fc & 0x7f, exception_code=pdu[1])
+
+    if fc in (3, 4):
+        if len(pdu) < 2 or pdu[1] & 1 or len(pdu) != pdu[1] + 2:
+            raise ModbusIOException('Invalid read response %s' % pdu)
+        n = pdu[1]
+        return Response(fc, list(struct.unpack_from('>%dH' % (n // 2), pdu, 2)))
+
+    return Response(fc)
+
+class TcpFramer:
+    '''Modbus TCP framing with MBAP headers
+
+    Each request gets a new transaction id which is returned along
+    with the encoded frame so responses can be matched to requests
+    regardless of the order in which they arrive.
+    '''
+
+    def __init__(self):
+        self.tid = 0
+        self.buf = b''
+
+    def encode(self, unit, pdu):
+        self.tid = (self.tid + 1) & 0xffff
+        return self.tid, MBAP.pack(self.tid, 0, len(pdu) + 1, unit) + pdu
+
+    def reset(self):
+        self.buf = b''
+
+    def decode(self, data):
+        '''Add received data and return complete frames
+
+        :returns: list of (transaction id, unit, pdu) tuples
+        '''
+
+        self.buf += data
+        frames = []
+
+        while len(self.buf) >= MBAP.size:
+            tid, proto, length, unit = MBAP.unpack_from(self.buf)
+            end = MBAP.size - 1 + length
+
+            if len(self.buf) < end:
+                break
+
+            if proto == 0 and length > 1:
+                frames.append((tid, unit, self.buf[MBAP.size:end]))
+            else:
+                log.debug('Invalid MBAP header %s', self.buf[:MBAP.size])
+
+            self.buf = self.buf[end:]
+
+        return frames
+
+class RtuFramer:
+    '''Modbus RTU framing with CRC'''
+
+    def encode(self, unit, pdu):
+        frame = bytes([unit]) + pdu
+        return frame + struct.pack('<H', crc16(frame))
+
+    def response_size(self, head):
+        '''Return the size of a response frame from its first 3 bytes'''
+
+        fc = head[1]
+
+        if fc & 0x80:
+            return 5
+        if fc in (3, 4):
+            return 5 + head[2]
+        return 8
+
+    def decode(self, unit, frame):
+        '''Check a complete response frame and return the PDU'''
+
+        if frame[0] != unit:
+            raise ValueError('Response from wrong unit %d' % frame[0])
+
+        if crc16(frame[:-2]) != struct.unpack_from('<H', frame, len(frame) - 2)[0]:
+            raise ValueError('CRC error')
+
+        return frame[1:-2]
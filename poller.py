@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+log = logging.getLogger(__name__)
+
+class Poller:
+    '''Update devices concurrently in a pool of worker threads
+
+    Only the Modbus transactions and register decoding run in the
+    workers.  Anything touching the D-Bus connection, such as
+    reinitialising a device or flushing changed values, stays on
+    the main loop which collects finished updates with `get_done()`.
+
+    Queued register writes are run separately with `submit_write()`
+    so they need not wait for a device update in progress.  They
+    take the bus ahead of any reads still waiting for it.
+
+    All methods must be called from the main loop.  The optional
+    `notify` callback is called from the worker thread whenever an
+    update finishes.
+
+    '''
+
+    def __init__(self, workers, notify=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='poll')
+        self.write_executor = ThreadPoolExecutor(max_workers=workers,
+                                                 thread_name_prefix='write')
+        self.busy = {}
+        self.writes = {}
+        self.notify = notify
+
+    def __contains__(self, dev):
+        return dev in self.busy
+
+    def submit(self, dev, func):
+        f = self.executor.submit(func)
+        self.busy[dev] = f
+        if self.notify:
+            f.add_done_callback(lambda f: self.notify())
+
+    def submit_write(self, dev, func):
+        f = self.writes.get(dev)
+        if f and not f.done():
+            return
+
+        self.writes[dev] = self.write_executor.submit(func)
+
+    def get_done(self):
+        '''Return finished updates
+
+        :returns: list of (device, exception) tuples, the exception
+                  being None for successful updates
+        '''
+
+        done = [d for d, f in self.busy.items() if f.done()]
+        return [(d, self.busy.pop(d).exception()) for d in done]
+
+    def wait(self, dev):
+        '''Wait for a pending update of a device to finish
+
+        The result is discarded.
+        '''
+
+        for f in self.busy.pop(dev, None), self.writes.pop(dev, None):
+            if f:
+                f.exception()
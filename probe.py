@@ -1,14 +1,46 @@
+import copy
 import logging
 import struct
 import time
 
 import client
+import store
 import utils
 
 log = logging.getLogger(__name__)
 
 device_types = []
 
+def probe_learned(m, modbus, timeout=None, filt=None):
+    '''Check for the device found at the same address last time
+
+    The model register is read once, with the unit id and access
+    type which worked before, and the device is only accepted if it
+    still reports the same model.
+
+    :returns: device object or None
+    '''
+
+    learned = store.get('probe', str(m))
+
+    if not learned:
+        return None
+
+    mm = m._replace(unit=learned['unit'])
+
+    if filt and not filt(mm):
+        return None
+
+    for t in device_types:
+        if t.methods and m.method not in t.methods:
+            continue
+
+        if t.has_handler(learned['handler']):
+            return t.probe(mm, modbus, timeout, learned['access'],
+                           learned['model'])
+
+    return None
+
 def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None):
     num_probed = 0
     found = []
@@ -25,40 +57,51 @@ def probe(mlist, pr_cb=None, pr_interval=10, timeout=None, filt=None):
         if not modbus:
             continue
 
-        d = None
-
-        for t in device_types:
-            if t.methods and m.method not in t.methods:
-                continue
-            log.debug("Probe for %s", next(iter(t.models.values()))["handler"].__name__)
-
-            units = [unit] if unit > 0 else t.units
-
-            try:
-                for u in units:
-                    mm = m._replace(unit=u)
-
-                    if filt and not filt(mm):
-                        continue
+        try:
+            t0 = time.time()
+            d = probe_learned(m, modbus, timeout, filt)
+            t1 = time.time()
+        except Exception as ex:
+            log.debug('Learned probe of %s failed: %s', m, ex)
+            d = None
 
-                    t0 = time.time()
-                    d = t.probe(mm, modbus, timeout)
-                    t1 = time.time()
-                    if d:
-                        break
-            except Exception:
-                log.exception("Reading from client %s",m)
-                break
+        if not d:
+            for t in device_types:
+                if t.methods and m.method not in t.methods:
+                    continue
+                log.debug("Probe for %s", next(iter(t.models.values()))["handler"].__name__)
+
+                units = [unit] if unit > 0 else t.units
+
+                try:
+                    for u in units:
+                        mm = m._replace(unit=u)
+
+                        if filt and not filt(mm):
+                            continue
+
+                        t0 = time.time()
+                        d = t.probe(mm, modbus, timeout)
+                        t1 = time.time()
+                        if d:
+                            break
+                except Exception:
+                    log.exception("Reading from client %s",m)
+                    break
 
-            if d:
-                d.log.info('Found %s: %s %s',
-                           d.device_type, d.vendor_name, d.model)
-                d.latency = t1 - t0
-                d.timeout = max(d.min_timeout, d.latency * 4)
-                found.append(d)
-                break
+                if d:
+                    break
 
-        if not d:
+        if d:
+            d.log.info('Found %s: %s %s',
+                       d.device_type, d.vendor_name, d.model)
+            d.latency = t1 - t0
+            d.timeout = max(d.min_timeout, d.latency * 4)
+            store.update('probe', str(m), handler=type(d).__name__,
+                         unit=d.unit, access=d.probe_access,
+                         model=d.probe_model)
+            found.append(d)
+        else:
             log.debug("... not found.")
             failed.append(m)
 
@@ -108,17 +151,29 @@ class ModelRegister:
         else:
             self.access = {m['handler'].default_access for m in models.values()}
 
-    def probe(self, spec, modbus, timeout=None):
+    def has_handler(self, name):
+        return any(m['handler'].__name__ == name for m in self.models.values())
+
+    def probe(self, spec, modbus, timeout=None, access=None, model=None):
+        '''Read the model register and create a device on a match
+
+        :param access: access type to use instead of trying all
+        :param model: model register value to accept, None for any
+        '''
+
+        acslist = [access] if access else self.access
+        reg = copy.copy(self.reg)
+
         with modbus, utils.timeout(modbus, timeout or self.timeout):
             if not modbus.connect():
                 raise Exception('connection error')
 
-            for acs in self.access:
+            for acs in acslist:
                 if acs == "holding":
                     rf = modbus.read_holding_registers
                 elif acs == "input":
                     rf = modbus.read_input_registers
-                rr = rf(address=self.reg.base, count=self.reg.count, slave=spec.unit)
+                rr = rf(address=reg.base, count=reg.count, slave=spec.unit)
                 if not rr.isError():
                     break
 
@@ -127,13 +182,18 @@ class ModelRegister:
             return None
 
         try:
-            self.reg.decode(rr.registers)
-            m = self.models[self.reg.value]
-            return m['handler'](spec, modbus, m['model'])
+            reg.decode(rr.registers)
+            if model is not None and reg.value != model:
+                return None
+            m = self.models[reg.value]
+            d = m['handler'](spec, modbus, m['model'])
+            d.probe_access = acs
+            d.probe_model = reg.value
+            return d
         except KeyError:
             return None
         except Exception:
-            log.exception("Decoding %s: %s",self.reg,rr)
+            log.exception("Decoding %s: %s",reg,rr)
             return None
 
     def get_models(self):
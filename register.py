@@ -3,9 +3,33 @@ import struct
 from utils import get_enum
 from collections.abc import Iterable
 
-class Reg:
-    def __new__(cls, *args, **kwargs):
-        return super().__new__(cls)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class RegType(type):
+    '''Accept register classes written for the unslotted layout
+
+    Registers used to derive from the builtin type of their value as
+    well, e.g. `class Reg_foo(Reg, int)`, which is not possible with
+    slots.  Such classes are still found in external driver modules,
+    so the builtin base is dropped and used as `vtype` instead.
+    '''
+
+    def __new__(mcs, name, bases, ns, **kwargs):
+        builtin = [b for b in bases if issubclass(b, (int, float, str))]
+
+        if builtin:
+            bases = tuple(b for b in bases if b not in builtin)
+            ns.setdefault('vtype', builtin[0])
+
+        return super().__new__(mcs, name, bases, ns, **kwargs)
+
+class Reg(metaclass=RegType):
+    __slots__ = ('base', 'count', 'name', 'value', 'write', 'onchange',
+                 'time', 'max_age', 'text', 'access')
+    vtype = None
 
     def __init__(self, base, count, name=None, text=None, write=False,
                  max_age=None, onchange=None, access=None):
@@ -63,11 +87,21 @@ class Reg:
     def copy_if_valid(self):
         return copy(self) if self.isvalid() else None
 
-class Reg_num(Reg, float):
+    def dbus_value(self):
+        if not self.isvalid():
+            return None
+        if self.vtype:
+            return self.vtype(self)
+        return self.value
+
+class Reg_num(Reg):
+    __slots__ = ('scale', 'invalid')
+    vtype = float
     rtype = int
 
     def __init__(self, base, name=None, scale=1, text=None, write=False, invalid=[], **kwargs):
-        super().__init__(base, self.count, name, text, write, **kwargs)
+        count = struct.calcsize(self.coding[1]) // 2
+        super().__init__(base, count, name, text, write, **kwargs)
         self.scale = float(scale) if scale != 1 else self.rtype(scale)
         self.invalid = list(invalid) if isinstance(invalid, Iterable) else [invalid]
 
@@ -76,9 +110,12 @@ class Reg_num(Reg, float):
 
     def decode(self, values):
         v = struct.unpack(self.coding[0], struct.pack(self.coding[1], *values))
-        if v[0] in self.invalid:
+        return self.decode_value(v[0])
+
+    def decode_value(self, v):
+        if v in self.invalid:
             return self.update(None)
-        return self.set_raw_value(v[0])
+        return self.set_raw_value(v)
 
     def encode(self):
         v = self.rtype(self.value * self.scale)
@@ -86,55 +123,58 @@ class Reg_num(Reg, float):
 
 class Reg_s16(Reg_num):
     coding = ('h', 'H')
-    count = 1
+    __slots__ = ()
 
 class Reg_u16(Reg_num):
     coding = ('H', 'H')
-    count = 1
+    __slots__ = ()
 
 class Reg_s32b(Reg_num):
     coding = ('>i', '>2H')
-    count = 2
+    __slots__ = ()
 
 class Reg_u32b(Reg_num):
     coding = ('>I', '>2H')
-    count = 2
+    __slots__ = ()
 
 class Reg_s64b(Reg_num):
     coding = ('>q', '>4H')
-    count = 4
+    __slots__ = ()
 
 class Reg_u64b(Reg_num):
     coding = ('>Q', '>4H')
-    count = 4
+    __slots__ = ()
 
 class Reg_f32b(Reg_num):
     coding = ('>f', '>2H')
-    count = 2
+    __slots__ = ()
     rtype = float
 
 class Reg_s32l(Reg_num):
     coding = ('<i', '<2H')
-    count = 2
+    __slots__ = ()
 
 class Reg_u32l(Reg_num):
     coding = ('<I', '<2H')
-    count = 2
+    __slots__ = ()
 
 class Reg_s64l(Reg_num):
     coding = ('<q', '<4H')
-    count = 4
+    __slots__ = ()
 
 class Reg_u64l(Reg_num):
     coding = ('<Q', '<4H')
-    count = 4
+    __slots__ = ()
 
 class Reg_f32l(Reg_num):
     coding = ('<f', '<2H')
-    count = 2
+    __slots__ = ()
     rtype = float
 
-class Reg_e16(Reg, int):
+class Reg_e16(Reg):
+    __slots__ = ('enum',)
+    vtype = int
+
     def __init__(self, base, name, enum, **kwargs):
         super().__init__(base, 1, name, **kwargs)
         self.enum = enum
@@ -147,7 +187,10 @@ class Reg_e16(Reg, int):
     def encode(self):
         return [self.value]
 
-class Reg_text(Reg, str):
+class Reg_text(Reg):
+    __slots__ = ('encoding', 'pfmt')
+    vtype = str
+
     def __init__(self, base, count, name=None, little=False, encoding=None, **kwargs):
         super().__init__(base, count, name, **kwargs)
         self.encoding = encoding or 'ascii'
@@ -163,6 +206,8 @@ class Reg_text(Reg, str):
             self.value.encode(self.encoding).ljust(2 * self.count, b'\0'))
 
 class Reg_map:
+    __slots__ = ()
+
     def __init__(self, base, name, tab, *args, **kwargs):
         super().__init__(base, name, *args, **kwargs)
         self.tab = tab
@@ -175,9 +220,11 @@ class Reg_map:
         return self.update(v)
 
 class Reg_mapu16(Reg_map, Reg_u16):
-    pass
+    __slots__ = ('tab',)
 
 class Reg_packed(Reg):
+    __slots__ = ('bits', 'mask', 'init_pos')
+
     def __init__(self, base, count, *args, bits, items, **kwargs):
         super().__init__(base, count, *args, **kwargs)
         self.bits = bits
@@ -202,7 +249,10 @@ class Reg_packed(Reg):
     def decode(self, values):
         return self.update(list(self.unpack(values)))
 
-class Reg_bit(Reg, int):
+class Reg_bit(Reg):
+    __slots__ = ('bit', 'set', 'unset')
+    vtype = int
+
     def __init__(self, base, *args, bit, set=1, unset=0, **kwargs):
         super().__init__(base, 1 + bit // 16, *args, **kwargs)
         self.bit = bit
@@ -212,3 +262,168 @@ class Reg_bit(Reg, int):
     def decode(self, values):
         v = values[self.bit // 16] & (1 << self.bit % 16)
         return self.update(self.set if v else self.unset)
+
+class RegRun:
+    '''Decode a run of evenly spaced registers of the same type with NumPy
+
+    The registers are read through a strided view of the packed block
+    and scaled with a single array operation.  All registers in a run
+    share the coding, the scale type and the invalid values.
+
+    :param regs: list of registers
+    :param start: first register address of the block
+    :param order: byte order of the packed block
+    '''
+
+    def __init__(self, regs, start, order):
+        r = regs[0]
+        self.regs = regs
+        self.dtype = numpy.dtype(order + r.coding[0].lstrip('<>'))
+        self.offset = 2 * (r.base - start)
+        self.stride = 2 * (regs[1].base - r.base)
+        self.invalid = r.invalid
+        self.scale = None
+
+        if isinstance(r.scale, float):
+            self.scale = numpy.array([x.scale for x in regs])
+
+    def decode(self, buf):
+        a = numpy.ndarray((len(self.regs),), self.dtype, buf,
+                          self.offset, (self.stride,))
+
+        if self.scale is not None:
+            v = (a / self.scale).tolist()
+        else:
+            v = a.tolist()
+
+        for x in self.invalid:
+            for i in numpy.flatnonzero(a == x):
+                v[i] = None
+
+        return v
+
+class BlockDecoder:
+    '''Decode a block of registers with a single precompiled struct
+
+    Registers using the plain `Reg_num` decoding are covered by one
+    `struct.Struct` spanning the whole block, with pad bytes for
+    holes and for other registers.  Since the struct uses a single
+    byte order, multi-word registers with a word order differing
+    from the first one are left out.  Registers not covered by the
+    struct are listed in `other` and must be decoded individually.
+
+    If NumPy is available, runs of at least `run_min` evenly spaced
+    registers of the same type are decoded as arrays instead.  The
+    values of those registers are returned already scaled and must
+    be applied with `update()` rather than `decode_value()`.  The
+    method to use for each register is listed in `setters`.
+
+    :param regs: list of registers sorted by address
+    :param start: first register address of the block
+    :param count: number of registers in the block
+    '''
+
+    run_min = 16
+
+    def __init__(self, regs, start, count):
+        self.other = []
+        self.runs = []
+
+        order = None
+        plain = []
+        pos = start
+
+        for r in regs:
+            ok = type(r).decode is Reg_num.decode and r.base >= pos
+
+            if ok and r.count > 1:
+                o = r.coding[0][0]
+                if order is None:
+                    order = o
+                ok = o == order
+
+            if not ok:
+                self.other.append(r)
+                continue
+
+            pos = r.base + r.count
+            plain.append(r)
+
+        order = order or '>'
+
+        if numpy:
+            plain = self.find_runs(plain, start, order)
+
+        fmt = ''
+        pos = start
+
+        for r in plain:
+            if r.base > pos:
+                fmt += '%dx' % (2 * (r.base - pos))
+
+            fmt += r.coding[0].lstrip('<>')
+            pos = r.base + r.count
+
+        if pos < start + count:
+            fmt += '%dx' % (2 * (start + count - pos))
+
+        self.words = struct.Struct('%s%dH' % (order, count))
+        self.struct = struct.Struct(order + fmt)
+
+        self.regs = plain
+        self.setters = [r.decode_value for r in plain]
+
+        for run in self.runs:
+            self.regs += run.regs
+            self.setters += [r.update for r in run.regs]
+
+    def run_key(self, r):
+        if r.count > 2:
+            return None
+        return (type(r).coding, type(r.scale), tuple(r.invalid))
+
+    def find_runs(self, regs, start, order):
+        '''Move runs of similar registers from `regs` to `runs`
+
+        :returns: list of the remaining registers
+        '''
+
+        rest = []
+        i = 0
+
+        while i < len(regs):
+            key = self.run_key(regs[i])
+            j = i + 1
+
+            if key and j < len(regs):
+                step = regs[j].base - regs[i].base
+                while (j < len(regs) and self.run_key(regs[j]) == key and
+                       regs[j].base - regs[j - 1].base == step):
+                    j += 1
+
+            if j - i >= self.run_min:
+                self.runs.append(RegRun(regs[i:j], start, order))
+            else:
+                j = i + 1
+                rest.append(regs[i])
+
+            i = j
+
+        return rest
+
+    def decode(self, values):
+        '''Return the values of the registers in `regs`
+
+        Values of registers decoded by the struct are raw, values of
+        registers in runs are scaled, None meaning invalid.
+        '''
+
+        buf = self.words.pack(*values)
+        v = self.struct.unpack(buf)
+
+        if self.runs:
+            v = list(v)
+            for run in self.runs:
+                v += run.decode(buf)
+
+        return v
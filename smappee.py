@@ -52,7 +52,10 @@ DEV_TYPES = {
 MAX_BUS_DEVICES = 10
 MAX_CT_SLOTS    = 28
 
-class Reg_ser(Reg, str):
+class Reg_ser(Reg):
+    __slots__ = ()
+    vtype = str
+
     def __init__(self, base, name):
         super().__init__(base, 4, name)
 
@@ -60,7 +63,10 @@ class Reg_ser(Reg, str):
         v = '%04d%06d' % (values[0], values[3] << 16 | values[2])
         return self.update(v)
 
-class Reg_ver(Reg, int):
+class Reg_ver(Reg):
+    __slots__ = ()
+    vtype = int
+
     def __init__(self, base, *args):
         super().__init__(base, 2, *args)
 
@@ -101,7 +107,8 @@ class CurrentTransformer:
     def set_phase(self, n):
         v = 0 if n < 0 else 1 << int(n)
         self.phase = n
-        self.dev.write_register(self.regs[0], v)
+        self.dev.write_modbus(self.regs[0].base, [v])
+        self.regs[0].value = n
 
         if n >= 0:
             for ct in self.dev.all_cts:
@@ -119,6 +126,7 @@ class PowerBox(device.CustomName, device.EnergyMeter):
     min_fwver = (1, 44)
     age_limit_fast = 0
     refresh_time = 100
+    write_single = False
 
     def probe_device(self, n):
         base = 0x1480 + 0x20 * n
@@ -130,18 +138,23 @@ class PowerBox(device.CustomName, device.EnergyMeter):
             Reg_ver(base + 0x04, '/Device/%d/FirmwareVersion' % n),
         ]
 
-        if self.read_register(regs[0]) == 0:
+        self.read_registers(regs[:2])
+
+        if regs[0].value == 0:
             return
 
-        slots = self.read_register(regs[1])
+        chans = {}
 
-        for s in range(slots):
+        for s in range(regs[1].value):
             addr = base + 0x0a + s + (s > 7)
             chan = chr(ord('A') + s)
-            sreg = Reg_u16(addr, '/Device/%d/Channel/%s/Slot' % (n, chan))
-            slot = self.read_register(sreg)
+            chans[chan] = Reg_u16(addr, '/Device/%d/Channel/%s/Slot' % (n, chan))
+
+        self.read_registers(list(chans.values()))
+
+        for chan, sreg in chans.items():
+            self.probe_ct(sreg.value, n, chan)
             regs.append(sreg)
-            self.probe_ct(slot, n, chan)
 
         self.info_regs += regs
 
@@ -204,10 +217,6 @@ class PowerBox(device.CustomName, device.EnergyMeter):
             Reg_u16( 0x1180, '/PhaseConfig', write=True),
         ]
 
-        self.data_regs = [
-            Reg_f32l(0x03f8, '/Ac/Frequency', 1, '%.1f Hz'),
-        ]
-
         fw = self.read_register(self.info_regs[1])
         if fw < self.min_fwver:
             self.log.info('%s firmware %s is too old', self.productname, fw)
@@ -218,10 +227,6 @@ class PowerBox(device.CustomName, device.EnergyMeter):
 
         self.all_cts = []
         self.ct_phase = [[], [], []]
-        self.voltage_regs = []
-        self.current_regs = []
-        self.power_regs = []
-        self.energy_regs = []
 
         for n in range(MAX_BUS_DEVICES):
             self.probe_device(n)
@@ -234,6 +239,18 @@ class PowerBox(device.CustomName, device.EnergyMeter):
                     ct.set_phase(n)
                     self.ct_phase[n].append(ct)
 
+        self.init_phases()
+
+    def init_phases(self):
+        self.data_regs = [
+            Reg_f32l(0x03f8, '/Ac/Frequency', 1, '%.1f Hz'),
+        ]
+
+        self.voltage_regs = []
+        self.current_regs = []
+        self.power_regs = []
+        self.energy_regs = []
+
         for n in range(3):
             if self.ct_phase[n]:
                 ct = self.ct_phase[n][0]
@@ -254,6 +271,14 @@ class PowerBox(device.CustomName, device.EnergyMeter):
         self.write_register(Reg_u16(0xfde8), 1)
         time.sleep(0.25)
 
+    def device_reconfigure(self):
+        # The bus devices and CTs are unchanged, only the phase
+        # assignments need to be applied.
+        self.ct_phase = [[ct for ct in self.all_cts if ct.phase == n]
+                         for n in range(3)]
+
+        self.init_phases()
+
     def ct_identify(self, ct, path, val):
         ct.identify(val)
         return False
@@ -272,10 +297,7 @@ class PowerBox(device.CustomName, device.EnergyMeter):
 
     def dbus_write_register(self, reg, path, val):
         super().dbus_write_register(reg, path, val)
-        self.sched_reinit()
-
-    def write_modbus(self, base, val):
-        self.modbus.write_registers(base, val, unit=self.unit)
+        self.sched_reconfigure()
 
 models = {
     5400: {
@@ -0,0 +1,116 @@
+'''Persistent store for things learned about devices
+
+The state is kept in a single JSON file with one section per kind
+of information, each mapping a key such as a device spec or ident
+to a dict of values.  Changes are kept in memory and written by
+`flush()` at most once every `FLUSH_INTERVAL` seconds to spare the
+flash, the file being replaced atomically so that a crash never
+leaves a partially written file behind.
+'''
+
+import copy
+import json
+import os
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+path = '/data/var/lib/dbus-modbus-client/learned.json'
+
+FLUSH_INTERVAL = 300
+
+lock = threading.Lock()
+data = None
+dirty = False
+flush_time = 0
+failed = False
+
+def load():
+    global data
+
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError('not a dict')
+    except FileNotFoundError:
+        data = {}
+    except (OSError, ValueError) as ex:
+        log.warning('Ignoring invalid state file %s: %s', path, ex)
+        data = {}
+
+def get(section, key):
+    '''Return the values stored for a key
+
+    :param section: name of the section
+    :param key: key within the section
+    :returns: dict of values, empty if nothing is stored
+    '''
+
+    with lock:
+        if data is None:
+            load()
+
+        return copy.deepcopy(data.get(section, {}).get(key, {}))
+
+def update(section, key, **values):
+    '''Update values stored for a key
+
+    Values set to None are removed.
+    '''
+
+    global dirty
+
+    with lock:
+        if data is None:
+            load()
+
+        ent = data.setdefault(section, {}).setdefault(key, {})
+
+        for k, v in values.items():
+            if v is None:
+                if ent.pop(k, None) is not None:
+                    dirty = True
+            elif ent.get(k) != v:
+                ent[k] = copy.deepcopy(v)
+                dirty = True
+
+def flush(force=False):
+    '''Write the store to disk if anything changed
+
+    :param force: write now even if the last write was less than
+                  `FLUSH_INTERVAL` seconds ago
+    '''
+
+    global dirty, flush_time, failed
+
+    with lock:
+        if not dirty:
+            return
+
+        now = time.monotonic()
+        if not force and now - flush_time < FLUSH_INTERVAL:
+            return
+
+        flush_time = now
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp'
+
+            with open(tmp, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tmp, path)
+            dirty = False
+            failed = False
+        except OSError as ex:
+            if failed:
+                log.debug('Failed to save state: %s', ex)
+            else:
+                log.warning('Failed to save state: %s', ex)
+                failed = True
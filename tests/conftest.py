@@ -0,0 +1,21 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The D-Bus libraries are only needed to run the service, not to
+# exercise the device code.
+for name in ('dbus', 'vedbus', 'settingsdevice'):
+    if name not in sys.modules:
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+
+for name in ('VeDbusService', 'VeDbusItemImport', 'VeDbusItemExport',
+             'ServiceContext'):
+    if not hasattr(sys.modules['vedbus'], name):
+        setattr(sys.modules['vedbus'], name, object)
+if not hasattr(sys.modules['settingsdevice'], 'SettingsDevice'):
+    sys.modules['settingsdevice'].SettingsDevice = object
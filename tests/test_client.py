@@ -0,0 +1,220 @@
+import importlib.util
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import client
+import devspec
+import framer
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dbus-modbus-client.py')
+
+@pytest.fixture
+def dmc(monkeypatch):
+    # the service libraries are not needed to probe devices
+    gi = types.ModuleType('gi')
+    gi.repository = types.ModuleType('gi.repository')
+    gi.repository.GLib = types.SimpleNamespace()
+    glib = types.ModuleType('dbus.mainloop.glib')
+    mods = {
+        'gi': gi,
+        'gi.repository': gi.repository,
+        'dbus.mainloop': types.ModuleType('dbus.mainloop'),
+        'dbus.mainloop.glib': glib,
+    }
+    try:
+        import mdns
+    except ImportError:
+        mods['mdns'] = types.SimpleNamespace(add_service=lambda svc: None)
+    for name, mod in mods.items():
+        monkeypatch.setitem(sys.modules, name, mod)
+    monkeypatch.setattr(sys.modules['dbus'], 'mainloop',
+                        mods['dbus.mainloop'], raising=False)
+    monkeypatch.setattr(mods['dbus.mainloop'], 'glib', glib, raising=False)
+    if not hasattr(sys.modules['dbus'], 'service'):
+        monkeypatch.setattr(sys.modules['dbus'], 'service',
+                            types.SimpleNamespace(
+                                method=lambda *a, **kw: lambda f: f),
+                            raising=False)
+
+    spec = importlib.util.spec_from_file_location('dmc', SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+class FakeDevice:
+    def __init__(self, spec):
+        self.spec = spec
+        self.destroyed = False
+
+    def read_device(self):
+        pass
+
+    def destroy(self):
+        self.destroyed = True
+
+    def __str__(self):
+        return str(self.spec)
+
+def test_probe_resolves_unit(dmc, monkeypatch):
+    found = []
+
+    def probe(devlist, filt=None):
+        # unit 0 is resolved to the actual unit by the probe
+        devs = [FakeDevice(m._replace(unit=1)) for m in devlist]
+        found.extend(devs)
+        return devs, []
+
+    monkeypatch.setattr(dmc.probe, 'probe', probe)
+
+    c = dmc.Client('test')
+    c.init_device = lambda d, nosave, enable: dmc.Device(d, nosave)
+
+    try:
+        spec = devspec.create('tcp', '192.0.2.1', 502, 0)
+        c.probe_devices([spec])
+        c.probe_done(True)
+    finally:
+        c.prober.shutdown()
+
+    assert len(found) == 1
+    assert not found[0].destroyed
+    assert [d.d for d in c.devices] == found
+    assert not c.failed
+    assert not c.probing
+
+class FakeSocket:
+    '''Device answering read requests with their register addresses
+
+    Responses to the requests sent together are returned in reverse
+    order, a few bytes at a time.
+    '''
+
+    def __init__(self, drop=()):
+        self.drop = drop
+        self.data = b''
+        self.closed = False
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, t):
+        pass
+
+    def sendall(self, data):
+        resp = []
+
+        while data:
+            tid, proto, length, unit = framer.MBAP.unpack_from(data)
+            fc, start, count = struct.unpack_from('>BHH', data, 7)
+            data = data[6 + length:]
+
+            if start in self.drop:
+                continue
+
+            pdu = struct.pack('>BB%dH' % count, fc, 2 * count,
+                              *range(start, start + count))
+            resp.insert(0, framer.MBAP.pack(tid, 0, len(pdu) + 1, unit) + pdu)
+
+        self.data += b''.join(resp)
+
+    def recv(self, size):
+        if not self.data:
+            raise socket.timeout()
+
+        data, self.data = self.data[:5], self.data[5:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+def pipelined_client(sock):
+    c = client.TcpClient('192.0.2.1', port=502)
+    c.key = ('tcp', '192.0.2.1', 502)
+    c.socket = sock
+    return c
+
+def test_pipelined_read():
+    sock = FakeSocket()
+    c = pipelined_client(sock)
+    reqs = [framer.read_pdu('holding', a, 2) for a in range(0, 100, 10)]
+
+    res = c.read_pipelined(reqs, 1, 3, 0.1)
+
+    assert [rr.registers for rr in res] == \
+        [[a, a + 1] for a in range(0, 100, 10)]
+    assert c.timeouts == 0
+    assert not sock.closed
+    c.put()
+
+def test_pipelined_read_depth():
+    sent = []
+    sock = FakeSocket()
+    c = pipelined_client(sock)
+    sendall = sock.sendall
+
+    def record(data):
+        sent.append(len(data) // 12)
+        sendall(data)
+
+    sock.sendall = record
+    reqs = [framer.read_pdu('input', a, 1) for a in range(8)]
+
+    res = c.read_pipelined(reqs, 1, 3, 0.1)
+
+    assert [rr.registers for rr in res] == [[a] for a in range(8)]
+    assert sent[0] == 3
+    assert sum(sent) == 8
+    c.put()
+
+def test_pipelined_read_no_response():
+    sock = FakeSocket(drop=(20,))
+    c = pipelined_client(sock)
+    reqs = [framer.read_pdu('holding', a, 2) for a in range(0, 50, 10)]
+
+    res = c.read_pipelined(reqs, 1, 2, 0.1)
+
+    assert [rr.registers for rr in res[:2]] == [[0, 1], [10, 11]]
+    assert res[2] is None
+    assert c.timeouts == 1
+    assert sock.closed
+    c.put()
+
+def test_bus_lock_order():
+    lock = client.BusLock()
+    order = []
+    threads = []
+
+    def worker(name, urgent):
+        with lock.urgent() if urgent else lock:
+            order.append(name)
+
+    lock.acquire()
+
+    for name, urgent in [('a', False), ('b', False),
+                         ('u1', True), ('c', False), ('u2', True)]:
+        t = threading.Thread(target=worker, args=(name, urgent))
+        t.start()
+        threads.append(t)
+        while lock.waiting < len(threads):
+            time.sleep(0.001)
+
+    # reentrant for the owner
+    with lock:
+        pass
+
+    assert order == []
+    lock.release()
+
+    for t in threads:
+        t.join()
+
+    assert order == ['u1', 'u2', 'a', 'b', 'c']
+    assert lock.max_waiting == 5
@@ -0,0 +1,174 @@
+import itertools
+import logging
+import math
+import random
+import types
+
+import pytest
+
+import client
+import device
+import devspec
+from register import Reg_f32b, Reg_u16, Reg_u32b
+import store
+from utils import flatten
+
+def test_disabled_device_releases_shared_client_once():
+    spec = devspec.create('tcp', '192.0.2.1', 502, 1)
+    key = ('tcp', '192.0.2.1', 502)
+
+    m = client.make_net_client(spec)
+    d1 = device.ModbusDevice(spec, m, 'test')
+    d2 = device.ModbusDevice(spec._replace(unit=2), m, 'test')
+    m.put()
+
+    try:
+        # as done by init() for a disabled device
+        d1.modbus_put()
+        d1.destroy()
+
+        assert client.net_clients.get(key) is m
+        assert m.refcount == 1
+    finally:
+        d2.destroy()
+
+    assert key not in client.net_clients
+
+class NetDevice(device.BaseDevice):
+    latency = 0.005
+
+    def __init__(self, method='tcp', rate=None):
+        super().__init__()
+        self.modbus = types.SimpleNamespace(
+            method=method,
+            comm_params=types.SimpleNamespace(baudrate=rate))
+        self.log = logging.getLogger('test')
+
+def test_pack_limits_holes_by_default():
+    d = NetDevice()
+
+    rr = d.pack_regs([Reg_u16(0, '/a'), Reg_u16(20, '/b')])
+    assert [[r.base for r in b] for b in rr] == [[0, 20]]
+
+    rr = d.pack_regs([Reg_u16(0, '/a'), Reg_u16(100, '/b')])
+    assert [[r.base for r in b] for b in rr] == [[0], [100]]
+
+    d.reg_hole_max = 200
+    rr = d.pack_regs([Reg_u16(0, '/a'), Reg_u16(100, '/b')])
+    assert [[r.base for r in b] for b in rr] == [[0, 100]]
+
+def test_rtu_latency_includes_frame_time():
+    d = NetDevice('rtu', 9600)
+    byte_time = device.modbus_byte_time('rtu', 9600)
+    frame = (device.modbus_overhead('rtu') + 2) * byte_time
+
+    d.latency = frame + 0.01
+    cost = d.read_cost()
+
+    assert cost[0] == pytest.approx(0.01 + frame - 2 * byte_time)
+    assert cost[1] == pytest.approx(2 * byte_time)
+
+def test_subdevices_flushed_by_post_update():
+    spec = devspec.create('tcp', '192.0.2.1', 502, 1)
+    m = client.make_net_client(spec)
+    d = device.ModbusDevice(spec, m, 'test')
+    m.put()
+
+    flushed = []
+    sub = types.SimpleNamespace(device_update=lambda: None,
+                                post_update=lambda: flushed.append(sub))
+
+    try:
+        d.subdevices = [sub]
+        d.update_data_regs = lambda: None
+        d.dbus = types.SimpleNamespace(flush=lambda: flushed.append(d))
+
+        # polling may run in a worker thread, away from D-Bus
+        d.device_update()
+        assert flushed == []
+
+        d.post_update()
+        assert flushed == [d, sub]
+    finally:
+        d.subdevices = []
+        d.dbus = None
+        d.destroy()
+
+def test_repack_rereads_registers(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'path', str(tmp_path / 'learned.json'))
+    monkeypatch.setattr(store, 'data', None)
+
+    d = NetDevice()
+    d.info = {'/Serial': 'test'}
+    d.min_interval = 0
+    d.unsupported = {}
+    regs = [Reg_u16(0, '/a'), Reg_u16(1, '/b')]
+    for r in regs:
+        r.max_age = 1
+        r.time = 1
+
+    d.data_regs = d.pack_regs(regs)
+
+    d.repack_data_regs()
+
+    assert [r.time for r in flatten(d.data_regs)] == [0, 0]
+
+def brute_force_plan(rr, cost, hole_max, barrier, min_interval):
+    rr = sorted(rr, key=lambda r: r.base)
+    best = math.inf
+
+    for cuts in itertools.product([False, True], repeat=len(rr) - 1):
+        blocks = [[rr[0]]]
+        for r, cut in zip(rr[1:], cuts):
+            if cut:
+                blocks.append([r])
+            else:
+                blocks[-1].append(r)
+
+        total = 0
+        for b in blocks:
+            for r0, r1 in zip(b, b[1:]):
+                end = r0.base + r0.count
+                if hole_max is not None and r1.base - end > hole_max or \
+                   device.contains_any(end, r1.base, barrier):
+                    total = math.inf
+
+            nr = max(r.base + r.count for r in b) - b[0].base
+            if nr > 125 and len(b) > 1:
+                total = math.inf
+
+            if min_interval is None:
+                age = 1
+            else:
+                age = min(max(r.max_age, min_interval) for r in b)
+            total += (cost[0] + cost[1] * nr) / age
+
+        best = min(best, total)
+
+    return best
+
+@pytest.mark.parametrize('seed', range(20))
+def test_plan_blocks_is_optimal(seed):
+    rnd = random.Random(seed)
+    classes = [Reg_u16, Reg_u32b, Reg_f32b]
+    regs = []
+    addr = rnd.randrange(100)
+
+    for i in range(rnd.randrange(1, 10)):
+        r = rnd.choice(classes)(addr, '/R%d' % i)
+        r.max_age = rnd.choice([1, 5])
+        regs.append(r)
+        addr += r.count + rnd.choice([0, 0, 1, 5, 30, 100])
+
+    cost = (rnd.uniform(0.001, 0.02), rnd.uniform(0.0001, 0.001))
+    hole_max = rnd.choice([None, 10, 50])
+    barrier = rnd.choice([None, [rnd.randrange(addr)]])
+    min_interval = rnd.choice([None, 1])
+
+    total, blocks = device.plan_blocks(regs, cost, hole_max, barrier,
+                                       min_interval)
+
+    assert sorted(r.name for b in blocks for r in b) == \
+        sorted(r.name for r in regs)
+    assert total == pytest.approx(brute_force_plan(regs, cost, hole_max,
+                                                   barrier, min_interval))
@@ -0,0 +1,77 @@
+import struct
+
+from pymodbus.exceptions import ModbusIOException
+import pytest
+
+import framer
+
+@pytest.mark.parametrize('pdu', [
+    b'',
+    b'\x83',
+    b'\x83\x02\x00',
+    b'\x03',
+    b'\x03\x04\x00\x01',
+    b'\x03\x03\x00\x01\x02',
+    b'\x04\x02\x00\x01\x02\x03',
+])
+def test_malformed_pdu(pdu):
+    with pytest.raises(ModbusIOException):
+        framer.decode_pdu(pdu)
+
+def test_rtu_frame():
+    f = framer.RtuFramer()
+    frame = f.encode(1, framer.read_pdu('holding', 0, 2))
+
+    # example from the Modbus over serial line specification
+    assert frame == bytes.fromhex('010300000002c40b')
+
+    resp = bytes([1, 3, 4, 0, 1, 0, 2])
+    resp += struct.pack('<H', framer.crc16(resp))
+
+    assert f.response_size(resp[:3]) == len(resp)
+    assert framer.decode_pdu(f.decode(1, resp)).registers == [1, 2]
+
+    with pytest.raises(ValueError):
+        f.decode(2, resp)
+
+    with pytest.raises(ValueError):
+        f.decode(1, resp[:4] + b'\xff' + resp[5:])
+
+def test_rtu_exception_size():
+    f = framer.RtuFramer()
+    resp = bytes([1, 0x83, 2])
+    resp += struct.pack('<H', framer.crc16(resp))
+
+    assert f.response_size(resp[:3]) == len(resp)
+
+    rr = framer.decode_pdu(f.decode(1, resp))
+    assert rr.isError()
+    assert rr.function_code == 3
+    assert rr.exception_code == 2
+
+def test_mbap_reassembly():
+    f = framer.TcpFramer()
+    t1, req1 = f.encode(5, framer.read_pdu('input', 10, 1))
+    t2, req2 = f.encode(5, framer.read_pdu('input', 20, 1))
+
+    assert t2 == t1 + 1
+    assert req1[7:] == bytes([4, 0, 10, 0, 1])
+
+    resp = framer.MBAP.pack(t2, 0, 5, 5) + bytes([4, 2, 0, 7])
+    resp += framer.MBAP.pack(t1, 0, 3, 5) + bytes([0x84, 2])
+
+    frames = []
+    for i in range(0, len(resp), 3):
+        frames += f.decode(resp[i:i + 3])
+
+    assert [(t, u) for t, u, pdu in frames] == [(t2, 5), (t1, 5)]
+    assert framer.decode_pdu(frames[0][2]).registers == [7]
+    assert framer.decode_pdu(frames[1][2]).exception_code == 2
+    assert f.buf == b''
+
+def test_mbap_invalid_header():
+    f = framer.TcpFramer()
+    resp = framer.MBAP.pack(1, 1, 3, 5) + bytes([3, 0])
+    resp += framer.MBAP.pack(2, 0, 5, 5) + bytes([3, 2, 0, 7])
+
+    assert [t for t, u, pdu in f.decode(resp)] == [2]
@@ -0,0 +1,96 @@
+from enum import IntEnum
+import random
+
+import register
+from register import (BlockDecoder, Reg, Reg_bit, Reg_e16, Reg_f32b, Reg_num,
+                      Reg_s16, Reg_s32b, Reg_text, Reg_u16, Reg_u32b,
+                      Reg_u32l, Reg_u64b)
+
+class Mode(IntEnum):
+    OFF = 1
+    ON = 2
+
+class Reg_old_int(Reg, int):
+    def __init__(self, base, name):
+        super().__init__(base, 1, name)
+
+class Reg_old_text(Reg, str):
+    def __init__(self, base, count, name):
+        super().__init__(base, count, name)
+
+    def decode(self, values):
+        return self.update(''.join(chr(v) for v in values))
+
+class Reg_old_num(Reg_num, float):
+    coding = ('>i', '>2H')
+    count = 2
+
+def test_builtin_base_becomes_vtype():
+    r = Reg_old_int(10, '/Old')
+    r.decode(7)
+    assert r.vtype is int
+    assert r.dbus_value() == 7
+
+    t = Reg_old_text(20, 2, '/Text')
+    t.decode([0x41, 0x42])
+    assert t.dbus_value() == 'AB'
+    assert t.copy_if_valid().value == 'AB'
+
+def test_count_class_attribute():
+    r = Reg_old_num(30, '/Num')
+    assert r.count == 2
+    r.decode([0, 5])
+    assert r.value == 5
+    assert r.dbus_value() == 5.0
+
+def block_regs():
+    regs = [
+        Reg_u16(100, '/U16', scale=10),
+        Reg_s16(101, '/S16', invalid=0x7fff),
+        Reg_u32b(102, '/U32b'),
+        Reg_s32b(105, '/S32b', scale=100),
+        Reg_f32b(107, '/F32b'),
+        Reg_u32l(109, '/U32l'),             # other word order
+        Reg_text(111, 4, '/Text'),
+        Reg_e16(115, '/Enum', Mode),
+        Reg_bit(116, '/Bit', bit=3),
+        Reg_u64b(117, '/U64b'),
+    ]
+
+    # long enough to be decoded as an array
+    regs += [Reg_s16(130 + 2 * i, '/Run/%d' % i, scale=10, invalid=-1)
+             for i in range(20)]
+
+    return regs
+
+def test_block_decoder_matches_registers():
+    rnd = random.Random(1)
+    start = 100
+    count = 170 - start
+
+    for n in range(20):
+        words = [rnd.randrange(0x10000) for i in range(count)]
+        words[101 - start] = 0x7fff if n == 1 else words[101 - start]
+        words[132 - start] = 0xffff if n == 2 else words[132 - start]
+        words[111 - start:115 - start] = [0x4142, 0x4300, 0, 0]
+        words[115 - start] = rnd.choice([1, 2, 5])
+
+        block = block_regs()
+        single = block_regs()
+
+        dec = BlockDecoder(block, start, count)
+        values = dec.decode(words)
+        for setter, v in zip(dec.setters, values):
+            setter(v)
+        for r in dec.other:
+            r.decode(words[r.base - start:r.base - start + r.count])
+
+        for r in single:
+            r.decode(words[r.base - start:r.base - start + r.count])
+
+        assert len(dec.regs) + len(dec.other) == len(single)
+        assert [repr(r.value) for r in block] == \
+            [repr(r.value) for r in single]
+
+    assert [r.name for r in dec.other] == ['/U32l', '/Text', '/Enum', '/Bit']
+    assert len(dec.runs) == (1 if register.numpy else 0)
@@ -0,0 +1,114 @@
+from contextlib import nullcontext
+import types
+
+import __main__
+import device
+import devspec
+import smappee
+import store
+
+class Response:
+    def __init__(self, registers=None):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+class FakeModbus:
+    method = 'udp'
+    host = 'powerbox'
+    native = False
+    gateway = False
+
+    def __init__(self):
+        self.mem = [0] * 0x10000
+        self.lock = types.SimpleNamespace(urgent=nullcontext)
+        self.comm_params = types.SimpleNamespace(timeout_connect=0.1)
+
+    def get(self):
+        return self
+
+    def read_holding_registers(self, address, count, **kwargs):
+        return Response(self.mem[address:address + count])
+
+    read_input_registers = read_holding_registers
+
+    def write_registers(self, address, values, **kwargs):
+        self.mem[address:address + len(values)] = values
+        return Response()
+
+    def write_register(self, address, value, **kwargs):
+        return self.write_registers(address, [value])
+
+class FakeService(dict):
+    def add_path(self, path, value, **kwargs):
+        assert path not in self
+        self[path] = value
+
+    def flush(self):
+        pass
+
+class FakeSettings(dict):
+    def addSettings(self, settings):
+        for k, v in settings.items():
+            self.setdefault(k, v[1])
+
+def make_powerbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'path', str(tmp_path / 'learned.json'))
+    monkeypatch.setattr(store, 'data', None)
+    monkeypatch.setattr(smappee.time, 'sleep', lambda t: None)
+    __main__.NAME = 'dbus-modbus-client'
+    __main__.VERSION = 'test'
+
+    modbus = FakeModbus()
+    mem = modbus.mem
+    mem[0x1624:0x1626] = [44, 1]            # firmware 1.44
+    mem[0x1480] = 5400                      # bus device 0 type
+    mem[0x1481] = 2                         # with two CT slots
+    mem[0x148a:0x148c] = [0, 1]             # channels A, B on slots 0, 1
+    mem[0x1000:0x1002] = [1, 2]             # CT 0 on L1, CT 1 on L2
+
+    spec = devspec.create('udp', 'powerbox', 502, 61)
+    d = smappee.PowerBox(spec, modbus, 'MOD-VAC-1')
+    d.timeout = 1
+    d.device_init()
+    d.read_info()
+
+    d.role = 'grid'
+    d.devinst = 40
+    d.settings = FakeSettings()
+    d._settings = {}
+    d.settings_path = '/Settings/Devices/test'
+    d.dbus = device.DbusPaths(FakeService())
+    d.init_dbus_paths()
+    d.init_data_regs()
+    d.device_init_late()
+
+    return d
+
+def test_phase_write_updates_dbus(tmp_path, monkeypatch):
+    d = make_powerbox(tmp_path, monkeypatch)
+
+    assert d.dbus['/CT/0/Phase'] == 0
+    assert d.dbus['/CT/1/Phase'] == 1
+    assert '/Ac/L3/Voltage' not in d.dbus
+
+    reg = d.info['/CT/0/Phase']
+    assert d.dbus_write_register(reg, '/CT/0/Phase', 2) is not False
+    d.reconfigure()
+
+    assert d.modbus.mem[0x1000] == 4
+    assert d.dbus['/CT/0/Phase'] == 2
+    assert d.dbus['/CT/1/Phase'] == 1
+    assert '/Ac/L3/Voltage' in d.dbus
+    assert '/Ac/L1/Voltage' not in d.dbus
+
+def test_unassigned_ct_is_not_l1(tmp_path, monkeypatch):
+    d = make_powerbox(tmp_path, monkeypatch)
+
+    reg = d.info['/CT/1/Phase']
+    d.dbus_write_register(reg, '/CT/1/Phase', 0)
+    d.reconfigure()
+
+    assert d.dbus['/CT/1/Phase'] == 0
+    assert d.dbus['/CT/0/Phase'] == -1
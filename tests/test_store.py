@@ -0,0 +1,39 @@
+import logging
+
+import store
+
+def setup_store(monkeypatch, path):
+    monkeypatch.setattr(store, 'path', str(path))
+    monkeypatch.setattr(store, 'data', None)
+    monkeypatch.setattr(store, 'dirty', False)
+    monkeypatch.setattr(store, 'flush_time', 0)
+    monkeypatch.setattr(store, 'failed', False)
+
+def test_flush_is_rate_limited(tmp_path, monkeypatch):
+    setup_store(monkeypatch, tmp_path / 'learned.json')
+    monkeypatch.setattr(store.time, 'monotonic', lambda: 1000)
+
+    store.update('devices', 'a', latency=0.1)
+    store.flush()
+    assert (tmp_path / 'learned.json').exists()
+
+    store.update('devices', 'a', latency=0.2)
+    store.flush()
+    assert store.dirty
+
+    store.flush(True)
+    assert not store.dirty
+    assert store.get('devices', 'a') == {'latency': 0.2}
+
+def test_write_failure_warns_once(tmp_path, monkeypatch, caplog):
+    (tmp_path / 'ro').write_text('')
+    setup_store(monkeypatch, tmp_path / 'ro' / 'learned.json')
+
+    store.update('devices', 'a', latency=0.1)
+
+    with caplog.at_level(logging.WARNING, logger='store'):
+        for i in range(3):
+            store.flush(True)
+
+    failures = [r for r in caplog.records if 'save' in r.getMessage()]
+    assert len(failures) == 1
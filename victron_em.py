@@ -20,6 +20,12 @@ class VE_Meter_A1B1(vreglink.VregLink, device.EnergyMeter):
     productname = 'Energy Meter VM-3P75CT'
     vreglink_base = 0x4000
     vreglink_size = 32
+    vreglink_static = (
+        0x0100,                 # product id
+        0x0102,                 # firmware version
+        0x010a,                 # serial number
+        0x010b,                 # model name
+    )
     role_names = ['grid', 'pvinverter', 'genset', 'acload', 'evcharger',
                   'heatpump', 'acload', 'acload']
     allowed_roles = None
@@ -171,7 +177,11 @@ class VE_Meter_A1B1(vreglink.VregLink, device.EnergyMeter):
         self.dbus['/Devices/0/CustomName'] = reg.value
 
     def pr_changed(self, reg):
-        self.sched_reinit()
+        if reg.base == 0x2001 and reg.value < len(self.role_names) and \
+           self.role_names[reg.value] != self.role:
+            self.sched_reinit()
+        else:
+            self.sched_reconfigure()
 
     def alarms_changed(self, reg):
         mapping = [None, 0, 1, 2]
@@ -1,6 +1,9 @@
 from register import *
 
-class VEReg_ver(Reg, int):
+class VEReg_ver(Reg):
+    __slots__ = ()
+    vtype = int
+
     def __init__(self, base, name):
         super().__init__(base, 2, name)
 
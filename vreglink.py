@@ -1,5 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 import dbus
+from gi.repository import GLib
 import struct
+import time
 
 from vedbus import VeDbusItemExport
 
@@ -13,18 +16,48 @@ class VregLinkItem(VeDbusItemExport):
         self.setvreg = setvreg
 
     @dbus.service.method('com.victronenergy.VregLink',
-                         in_signature='q', out_signature='qay')
-    def GetVreg(self, regid):
-        return self.getvreg(int(regid))
+                         in_signature='q', out_signature='qay',
+                         async_callbacks=('reply', 'error'))
+    def GetVreg(self, regid, reply, error):
+        self.getvreg(int(regid), reply, error)
 
     @dbus.service.method('com.victronenergy.VregLink',
-                         in_signature='qay', out_signature='qay')
-    def SetVreg(self, regid, data):
-        return self.setvreg(int(regid), bytes(data))
+                         in_signature='qay', out_signature='qay',
+                         async_callbacks=('reply', 'error'))
+    def SetVreg(self, regid, data, reply, error):
+        self.setvreg(int(regid), bytes(data), reply, error)
 
 class VregLink:
+    '''Access to vregs through a block of Modbus registers
+
+    Transactions run in a worker thread, taking the bus ahead of
+    register polling, and the D-Bus replies are sent from the main
+    loop once they complete.  Successful reads of the vregs listed in
+    `vreglink_static`, which must not change by themselves, are
+    cached for `vreglink_cache_time` seconds, any write clearing the
+    cache.
+    '''
+
+    vreglink_static = ()
+    vreglink_cache_time = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vreglink_executor = None
+        self.vreglink_cache = {}
+
+    def destroy(self):
+        if self.vreglink_executor:
+            self.vreglink_executor.shutdown(wait=False, cancel_futures=True)
+            self.vreglink_executor = None
+        super().destroy()
+
     def device_init_late(self):
         super().device_init_late()
+        if not self.vreglink_executor:
+            self.vreglink_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='vreg')
+        self.vreglink_cache.clear()
         vregtype = lambda *args, **kwargs: VregLinkItem(*args, **kwargs,
             getvreg=self.vreglink_get, setvreg=self.vreglink_set)
         self.dbus.add_path('/Devices/0/VregLink', None, itemtype=vregtype)
@@ -33,15 +66,51 @@ class VregLink:
         self.dbus.add_path('/Devices/0/ProductName', self.productname)
         self.dbus.add_path('/Devices/0/ServiceName', self.dbus.get_name())
         self.dbus.add_path('/Devices/0/CustomName', self.dbus['/CustomName'])
-        self.dbus.add_path('/Devices/0/FirmwareVersion',
-                           self.dbus['/FirmwareVersion'])
+        self.dbus_add_register(self.info['/FirmwareVersion'],
+                               '/Devices/0/FirmwareVersion')
         self.dbus.add_path('/Devices/0/IpAddress', self.spec.target)
 
-    def vreglink_get(self, regid):
-        return self.vreglink_exec(regid)
+    def vreglink_get(self, regid, reply, error):
+        c = self.vreglink_cache.get(regid)
+        if c and time.time() - c[0] < self.vreglink_cache_time:
+            reply(*c[1])
+            return
+
+        self.vreglink_submit(regid, None, reply, error)
+
+    def vreglink_set(self, regid, data, reply=None, error=None):
+        self.vreglink_cache.clear()
+        self.vreglink_submit(regid, data, reply, error)
+
+    def vreglink_submit(self, regid, data, reply, error):
+        f = self.vreglink_executor.submit(self.vreglink_exec, regid, data)
+        f.add_done_callback(lambda f: GLib.idle_add(
+            self.vreglink_done, f, regid, data, reply, error))
+
+    def vreglink_done(self, f, regid, data, reply, error):
+        if f.cancelled():
+            return False
+
+        ex = f.exception()
+
+        if ex:
+            self.log.error('Error accessing vreg %#04x: %s', regid, ex)
+            if error:
+                error(ex)
+            return False
+
+        res = f.result()
+
+        if data is None and res[0] == 0:
+            if regid in self.vreglink_static:
+                self.vreglink_cache[regid] = (time.time(), res)
+        elif data is not None:
+            self.vreglink_cache.clear()
+
+        if reply:
+            reply(*res)
 
-    def vreglink_set(self, regid, data):
-        return self.vreglink_exec(regid, data)
+        return False
 
     def vreglink_exec(self, regid, data=None):
         iswrite = data is not None
@@ -59,11 +128,13 @@ class VregLink:
 
         nread = 3 + self.vreglink_size
 
-        r = self.modbus.readwrite_registers(read_address=self.vreglink_base,
-                                            read_count=nread,
-                                            write_address=self.vreglink_base,
-                                            write_registers=data,
-                                            unit=self.unit)
+        with self.modbus.lock.urgent():
+            r = self.modbus.readwrite_registers(
+                read_address=self.vreglink_base,
+                read_count=nread,
+                write_address=self.vreglink_base,
+                write_registers=data,
+                slave=self.unit)
 
         if r.isError():
             self.log.error('Modbus error accessing vreg %#04x: %s', regid, r)